@@ -4,14 +4,16 @@ it checks for any new arxiv papers via the arxiv API and stashes
 them into a sqlite database.
 """
 
+import os
 import sys
-import time
-import random
 import logging
 import argparse
 
-from aslite.arxiv import get_response, parse_response
-from aslite.db import get_papers_db, get_metas_db
+from aslite.arxiv import PageFetcher, API_URL, PAGE_SIZE, Q_CATEGORIES
+from aslite.ratelimit import RateLimiter
+from aslite.db import get_papers_db, get_metas_db, get_search_index, upsert_papers, SEARCH_DB_FILE
+from aslite.db import save_time_index, TIME_INDEX_FILE
+from aslite.db import save_cursor, load_cursor, clear_cursor
 
 if __name__ == '__main__':
 
@@ -21,6 +23,10 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--num', type=int, default=100, help='up to how many papers to fetch')
     parser.add_argument('-s', '--start', type=int, default=0, help='start at what index')
     parser.add_argument('-b', '--break-after', type=int, default=3, help='how many 0 new papers in a row would cause us to stop early? or 0 to disable.')
+    parser.add_argument('-r', '--rate', type=float, default=1/3, help='maximum number of api requests per second, arxiv asks for at most one every 3 seconds')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted run from its saved cursor, instead of at --start')
+    parser.add_argument('--api-url', type=str, default=API_URL, help='the arxiv api endpoint, e.g. a local stand-in server for testing')
+    parser.add_argument('--record', type=str, default='', help='directory to also save the raw api responses into, replay_arxiv.py can serve them back as a stand-in api')
     args = parser.parse_args()
     print(args)
     """
@@ -29,93 +35,89 @@ if __name__ == '__main__':
     we've reached older papers that are already part of the database, to spare the arxiv API.
     """
 
-    # query string of papers to look for
-    q_categories = ['eess.IV', # Image and Video Proc
-                    'eess.AS', # Audio and Speech Proc
-                    'cs.AI', # AI
-                    'cs.CL', # Computation and Lang
-                    'cs.CV', # CompVis / Pattern Rec
-                    'cs.HC', # HCI
-                    'cs.LG', # Machine Learning
-                    'cs.NE', # Neural and Evolutionary Comp
-                    'cs.RO', # Robotics
-                    ]
-
+    # query string of papers to look for, see Q_CATEGORIES in aslite/arxiv.py
     def combine_categories(categories):
         return '+OR+'.join(['cat:' + category for category in categories])
 
-    q = combine_categories(q_categories)
+    q = combine_categories(Q_CATEGORIES)
 
-    pdb = get_papers_db(flag='c')
-    mdb = get_metas_db(flag='c')
+    # the papers, metas and cards are written by upsert_papers, a whole page in one transaction
+    pdb = get_papers_db(flag='r')
+    mdb = get_metas_db(flag='r')
+    # only keep an existing search index up to date. building it is left to compute.py, over all
+    # the papers, because an index of just the papers of this run would hide all the others
+    sidx = get_search_index(flag='c') if os.path.isfile(SEARCH_DB_FILE) else None
     prevn = len(pdb)
 
-    def store(p):
-        pdb[p['_id']] = p
-        mdb[p['_id']] = {'_time': p['_time']}
-
-    # fetch the latest papers
+    # the range of pages to fetch, possibly continuing an interrupted run
+    start, end = args.start, args.start + args.num
+    if args.resume:
+        cursor = load_cursor('arxiv')
+        if cursor is not None and cursor['query'] == q:
+            start, end = cursor['next'], cursor['end']
+            logging.info('resuming the previous run at start_index %d' % (start, ))
+        else:
+            logging.info('no previous run of this query to resume, starting at start_index %d' % (start, ))
+
+    def record(k, resp):
+        with open(os.path.join(args.record, 'start_%d.xml' % (k, )), 'wb') as f:
+            f.write(resp)
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+
+    # fetch the latest papers. the pages are fetched and parsed in the background
+    # while we store the previous ones, paced at args.rate requests per second
+    logging.info('querying arxiv api for query %s at start_index %d' % (q, start))
+    fetcher = PageFetcher(q, range(start, end, PAGE_SIZE), RateLimiter(args.rate), api_url=args.api_url,
+                          on_response=record if args.record else None)
     total_updated = 0
     zero_updates_in_a_row = 0
-    for k in range(args.start, args.start + args.num, 100):
-        logging.info('querying arxiv api for query %s at start_index %d' % (q, k))
-
-        # attempt to fetch a batch of papers from arxiv api
-        ntried = 0
-        while True:
-            try:
-                resp = get_response(search_query=q, start_index=k)
-                papers = parse_response(resp)
-                time.sleep(0.5)
-                if len(papers) == 100:
-                    break # otherwise we have to try again
-            except Exception as e:
-                logging.warning(e)
-                logging.warning("will try again in a bit...")
-                ntried += 1
-                if ntried > 1000:
-                    logging.error("ok we tried 1,000 times, something is srsly wrong. exitting.")
-                    sys.exit()
-                time.sleep(2 + random.uniform(0, 4))
-
-        # process the batch of retrieved papers
-        nhad, nnew, nreplace = 0, 0, 0
-        for p in papers:
-            pid = p['_id']
-            if pid in pdb:
-                if p['_time'] > pdb[pid]['_time']:
-                    # replace, this one is newer
-                    store(p)
-                    nreplace += 1
-                else:
-                    # we already had this paper, nothing to do
-                    nhad += 1
+    try:
+        for k, papers in fetcher:
+
+            # store the new papers and the newer versions of the ones we had, skip the rest
+            new, replaced = upsert_papers(papers)
+            if sidx is not None:
+                sidx.add(new + replaced)
+                sidx.commit()
+            nnew, nreplace = len(new), len(replaced)
+            nhad = len(papers) - nnew - nreplace
+            prevn = len(pdb)
+            total_updated += nreplace + nnew
+            save_cursor('arxiv', {'query': q, 'next': k + PAGE_SIZE, 'end': end})
+
+            # some diagnostic information on how things are coming along
+            if papers:
+                logging.info(papers[0]['_time_str'])
+            logging.info("k=%d, out of %d: had %d, replaced %d, new %d. now have: %d" %
+                 (k, len(papers), nhad, nreplace, nnew, prevn))
+
+            # early termination criteria
+            if nnew == 0:
+                zero_updates_in_a_row += 1
+                if args.break_after > 0 and zero_updates_in_a_row >= args.break_after:
+                    logging.info("breaking out early, no new papers %d times in a row" % (args.break_after, ))
+                    break
+                elif k == 0:
+                    logging.info("our very first call for the latest there were no new papers, exitting")
+                    break
             else:
-                # new, simple store into database
-                store(p)
-                nnew += 1
-        prevn = len(pdb)
-        total_updated += nreplace + nnew
-
-        # some diagnostic information on how things are coming along
-        logging.info(papers[0]['_time_str'])
-        logging.info("k=%d, out of %d: had %d, replaced %d, new %d. now have: %d" %
-             (k, len(papers), nhad, nreplace, nnew, prevn))
-
-        # early termination criteria
-        if nnew == 0:
-            zero_updates_in_a_row += 1
-            if args.break_after > 0 and zero_updates_in_a_row >= args.break_after:
-                logging.info("breaking out early, no new papers %d times in a row" % (args.break_after, ))
-                break
-            elif k == 0:
-                logging.info("our very first call for the latest there were no new papers, exitting")
-                break
-        else:
-            zero_updates_in_a_row = 0
-
-        # zzz
-        time.sleep(1 + random.uniform(0, 3))
+                zero_updates_in_a_row = 0
+    except RuntimeError as e:
+        # the cursor stays, so the run can be resumed once arxiv is happy again
+        logging.error("%s. exitting." % (e, ))
+        sys.exit(1)
+    finally:
+        fetcher.close()
+    clear_cursor('arxiv') # this run is complete
+
+    if sidx is not None:
+        sidx.close()
+
+    # refresh the time-sorted index of all papers that serve.py ranks and filters with
+    if total_updated > 0 or not os.path.isfile(TIME_INDEX_FILE):
+        logging.info("rebuilding the time index...")
+        save_time_index(mdb.items())
 
     # exit with OK status if anything at all changed, but if nothing happened then raise 1
     sys.exit(0 if total_updated > 0 else 1)
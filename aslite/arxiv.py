@@ -2,23 +2,42 @@
 Utils for dealing with arxiv API and related processing
 """
 
+import io
 import time
+import queue
+import random
 import logging
+import threading
+import email.utils
 import urllib.request
-import feedparser
+import xml.etree.ElementTree as ET
 from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-def get_response(search_query, start_index=0):
+API_URL = 'http://export.arxiv.org/api/query?'
+PAGE_SIZE = 100 # papers per api call
+
+# the categories of papers that we collect
+Q_CATEGORIES = ['eess.IV', # Image and Video Proc
+                'eess.AS', # Audio and Speech Proc
+                'cs.AI', # AI
+                'cs.CL', # Computation and Lang
+                'cs.CV', # CompVis / Pattern Rec
+                'cs.HC', # HCI
+                'cs.LG', # Machine Learning
+                'cs.NE', # Neural and Evolutionary Comp
+                'cs.RO', # Robotics
+                ]
+
+def get_response(search_query, start_index=0, api_url=API_URL):
     """ pings arxiv.org API to fetch a batch of 100 papers """
     # fetch raw response
-    base_url = 'http://export.arxiv.org/api/query?'
-    add_url = 'search_query=%s&sortBy=lastUpdatedDate&start=%d&max_results=100' % (search_query, start_index)
+    add_url = 'search_query=%s&sortBy=lastUpdatedDate&start=%d&max_results=%d' % (search_query, start_index, PAGE_SIZE)
     #add_url = 'search_query=%s&sortBy=submittedDate&start=%d&max_results=100' % (search_query, start_index)
-    search_query = base_url + add_url
+    search_query = api_url + add_url
     logger.debug(f"Searching arxiv for {search_query}")
-    with urllib.request.urlopen(search_query) as url:
+    with urllib.request.urlopen(search_query, timeout=60) as url:
         response = url.read()
 
     if url.status != 200:
@@ -26,15 +45,6 @@ def get_response(search_query, start_index=0):
 
     return response
 
-def encode_feedparser_dict(d):
-    """ helper function to strip feedparser objects using a deep copy """
-    if isinstance(d, feedparser.FeedParserDict) or isinstance(d, dict):
-        return {k: encode_feedparser_dict(d[k]) for k in d.keys()}
-    elif isinstance(d, list):
-        return [encode_feedparser_dict(k) for k in d]
-    else:
-        return d
-
 def parse_arxiv_url(url):
     """
     examples is http://arxiv.org/abs/1512.08756v2
@@ -47,25 +57,47 @@ def parse_arxiv_url(url):
     assert len(parts) == 2, 'error splitting id and version in idv string: ' + idv
     return idv, parts[0], int(parts[1])
 
-def parse_response(response):
+ATOM = '{http://www.w3.org/2005/Atom}' # namespace of the atom elements of the api responses
+
+def parse_entry(e):
+    """ turns the <entry> element of one paper into our compact paper record """
+    idv, rawid, version = parse_arxiv_url(e.findtext(ATOM + 'id').strip())
+    updated = e.findtext(ATOM + 'updated').strip()
+    updated_parsed = time.strptime(updated, '%Y-%m-%dT%H:%M:%SZ')[:8] + (0, ) # utc, like feedparser gave us
+    links = [{'type': 'text/html', **l.attrib} for l in e.iterfind(ATOM + 'link')] # the type defaults like in feedparser
+    return {
+        'id': e.findtext(ATOM + 'id').strip(),
+        'title': e.findtext(ATOM + 'title', '').strip(),
+        'summary': e.findtext(ATOM + 'summary', '').strip(),
+        'authors': [{'name': a.findtext(ATOM + 'name', '').strip()} for a in e.iterfind(ATOM + 'author')],
+        'tags': [{'term': t.get('term')} for t in e.iterfind(ATOM + 'category')],
+        'links': links,
+        'link': next((l['href'] for l in links if l.get('rel') == 'alternate'), ''),
+        'updated': updated,
+        '_idv': idv,
+        '_id': rawid,
+        '_version': version,
+        '_time': time.mktime(updated_parsed),
+        '_time_str': time.strftime('%b %d %Y', updated_parsed),
+    }
+
+def iter_response(source):
+    """
+    streams the papers out of an api response (a path or a binary file object) with
+    an incremental xml parser, yielding the record of every entry as soon as it is
+    complete and then dropping its elements, so memory stays flat however big it is
+    """
+    root = None
+    for event, el in ET.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = el
+        elif event == 'end' and el.tag == ATOM + 'entry':
+            yield parse_entry(el)
+            root.clear()
 
-    out = []
-    parse = feedparser.parse(response)
-    for e in parse.entries:
-        j = encode_feedparser_dict(e)
-        # extract / parse id information
-        idv, rawid, version = parse_arxiv_url(j['id'])
-        j['_idv']= idv
-        j['_id'] = rawid
-        j['_version'] = version
-        j['_time'] = time.mktime(j['updated_parsed'])
-        j['_time_str'] = time.strftime('%b %d %Y', j['updated_parsed'])
-        # delete apparently spurious and redundant information
-        del j['summary_detail']
-        del j['title_detail']
-        out.append(j)
-
-    return out
+def parse_response(response):
+    """ parses the raw bytes of an api response into the list of its paper records """
+    return list(iter_response(io.BytesIO(response)))
 
 def filter_latest_version(idvs):
     """
@@ -78,4 +110,142 @@ def filter_latest_version(idvs):
         pid_to_v[pid] = max(int(v), pid_to_v.get(pid, 0))
 
     filt = [f"{pid}v{v}" for pid, v in pid_to_v.items()]
-    return filt
\ No newline at end of file
+    return filt
+
+def parse_snapshot_record(r):
+    """
+    turns one record of the arxiv metadata snapshot (the json lines dump of all of
+    arxiv, e.g. arxiv-metadata-oai-snapshot.json) into the same paper record that
+    parse_response makes out of the api. like in the api, the time of a paper is
+    the time of its latest version
+    """
+    latest = r['versions'][-1]
+    version = int(latest['version'].lstrip('v'))
+    updated_parsed = email.utils.parsedate(latest['created'])[:8] + (0, ) # utc, like the api's
+    if r.get('authors_parsed'):
+        # (last, first, suffix) triples, the api gives them as "first last suffix"
+        authors = [' '.join(n for n in (first, last, suffix) if n) for last, first, suffix, *_ in r['authors_parsed']]
+    else:
+        authors = [a.strip() for a in r['authors'].replace(' and ', ', ').split(',') if a.strip()]
+    idv = '%sv%d' % (r['id'], version)
+    return {
+        'id': 'http://arxiv.org/abs/' + idv,
+        'title': r['title'].strip(),
+        'summary': r['abstract'].strip(),
+        'authors': [{'name': a} for a in authors],
+        'tags': [{'term': t} for t in r['categories'].split()],
+        'links': [{'href': 'http://arxiv.org/abs/' + idv, 'rel': 'alternate', 'type': 'text/html'},
+                  {'title': 'pdf', 'href': 'http://arxiv.org/pdf/' + idv, 'rel': 'related', 'type': 'application/pdf'}],
+        'link': 'http://arxiv.org/abs/' + idv,
+        'updated': time.strftime('%Y-%m-%dT%H:%M:%SZ', updated_parsed),
+        '_idv': idv,
+        '_id': r['id'],
+        '_version': version,
+        '_time': time.mktime(updated_parsed),
+        '_time_str': time.strftime('%b %d %Y', updated_parsed),
+    }
+
+# -----------------------------------------------------------------------------
+
+class PageFetcher:
+    """
+    fetches and parses the pages of a query in the background, so that the network and
+    whatever the caller does with the papers (storing them) overlap: a thread fetches
+    the pages in order, a single request at a time and paced by the limiter as the arxiv
+    api asks, parses each one while it waits for the limiter, and iterating the fetcher
+    yields (start_index, papers) in order. a bounded queue keeps at most a few pages in
+    flight, and close() stops the thread early.
+    """
+
+    def __init__(self, search_query, starts, limiter, api_url=API_URL,
+                 queue_size=2, max_tries=1000, short_retries=3, on_response=None):
+        self.search_query = search_query
+        self.starts = starts
+        self.limiter = limiter
+        self.api_url = api_url
+        self.max_tries = max_tries # attempts per page before giving up on the whole run
+        self.short_retries = short_retries # re-fetches of a page that came back with fewer than PAGE_SIZE papers
+        self.on_response = on_response # optional callback(start_index, raw response), e.g. to record them
+        self._parsed = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fetch_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _put(self, q, item):
+        # blocks while the queue is full, unless we are told to stop
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def fetch(self, k):
+        """
+        fetches and parses the page at start index k, returning the raw response and its
+        papers. network errors and responses that don't parse (e.g. truncated) are retried alike
+        """
+        ntried, nshort = 0, 0
+        while not self._stop.is_set():
+            self.limiter.acquire()
+            try:
+                resp = get_response(self.search_query, start_index=k, api_url=self.api_url)
+                papers = parse_response(resp)
+            except Exception as e:
+                ntried += 1
+                if ntried >= self.max_tries:
+                    raise RuntimeError("tried page %d %d times, something is srsly wrong" % (k, ntried)) from e
+                logger.warning("fetching page %d failed: %s. will try again in a bit..." % (k, e))
+                time.sleep(2 + random.uniform(0, 4))
+                continue
+            # the api sometimes returns short pages for no reason, but the last page is legitimately short
+            if len(papers) < PAGE_SIZE and nshort < self.short_retries:
+                nshort += 1
+                logger.warning("page %d came back short, trying again" % (k, ))
+                continue
+            return resp, papers
+        return None
+
+    def _fetch_loop(self):
+        try:
+            for k in self.starts:
+                fetched = self.fetch(k)
+                if fetched is None:
+                    return # stopped
+                resp, papers = fetched
+                if self.on_response is not None:
+                    self.on_response(k, resp)
+                if not self._put(self._parsed, (k, papers)):
+                    return
+        except Exception as e:
+            self._put(self._parsed, e)
+            return
+        self._put(self._parsed, StopIteration)
+
+    def __iter__(self):
+        while True:
+            item = self._get(self._parsed)
+            if item is None or item is StopIteration:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -5,10 +5,21 @@ Any of the file system I/O and the associated settings are in this single file.
 """
 
 import os
+import json
+import time
+import shutil
+import hashlib
+import atexit
+import threading
 import sqlite3, zlib, pickle, tempfile
+import numpy as np
+import scipy.sparse as sp
+import sqlitedict
 from sqlitedict import SqliteDict
 from contextlib import contextmanager
 
+from aslite.search import SearchIndex
+
 # -----------------------------------------------------------------------------
 # global configuration
 
@@ -78,19 +89,418 @@ def safe_pickle_dump(obj, fname):
         pickle.dump(obj, f, -1) # -1 specifies highest binary protocol
 
 # -----------------------------------------------------------------------------
+"""
+process-resident caching of the files that compute.py and friends publish.
+all of our writers publish via an atomic rename (see open_atomic above), so the
+moment the (mtime, size, inode) of a file changes, the new version is complete.
+"""
+
+class FileCache:
+    """
+    keeps loader(version) resident in the process and calls it again only when
+    the file at path changes on disk. the loaded object is swapped in with a
+    single reference assignment, so callers that hold on to an object they got
+    earlier keep a consistent view even while a reload happens underneath them.
+    """
+
+    def __init__(self, path, loader):
+        self.path = path
+        self.loader = loader
+        self.version = None
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def _stat_version(self):
+        st = os.stat(self.path)
+        return '%d-%d-%d' % (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self):
+        version = self._stat_version()
+        if version != self.version:
+            with self._lock:
+                # another thread may have done the reload while we were waiting
+                if version != self.version:
+                    self._obj = self.loader(version)
+                    self.version = version
+        return self._obj
+
+# -----------------------------------------------------------------------------
+"""
+codecs for the values we store in the sqlite tables. a codec is a serializer that
+turns an object into bytes, followed by a compression of those bytes, and every
+stored value starts with a byte that records the compression it was written with.
+so the compression of a table can be changed at any time, and the rows written
+before that keep reading fine. the values written before there was such a byte
+are bare zlib streams (first byte 0x78) or bare pickles (0x80), and none of the
+compression ids collide with those.
+"""
+
+# the serializers, as (dumps, loads) pairs between an object and bytes
+
+def _pickle_dumps(obj):
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+def _card_dumps(card):
+    # a card is stored as just the tuple of its field values, in CARD_FIELDS order
+    return pickle.dumps(tuple(card[f] for f in CARD_FIELDS), pickle.HIGHEST_PROTOCOL)
+
+def _card_loads(data):
+    return dict(zip(CARD_FIELDS, pickle.loads(data)))
+
+def _paper_dumps(p):
+    # a paper is stored as its schema version followed by the values of the fields of that version
+    row = (PAPER_SCHEMA, p['_id'], p['_version'], p['_time'], p['_time_str'], p['title'], p['summary'],
+           tuple(a['name'] for a in p['authors']), tuple(t['term'] for t in p['tags']),
+           p.get('link', ''), p.get('llm_summary'))
+    return pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+
+def _paper_loads(data):
+    row = pickle.loads(data)
+    if isinstance(row, dict):
+        return row # a full feedparser record, from before the compact schema
+    p = dict(zip(PAPER_SCHEMAS[row[0]], row[1:]))
+    p['_idv'] = '%sv%d' % (p['_id'], p['_version'])
+    p['authors'] = [{'name': a} for a in p['authors']]
+    p['tags'] = [{'term': t} for t in p['tags']]
+    if p['llm_summary'] is None:
+        del p['llm_summary']
+    return p
+
+SERIALIZERS = {
+    'pickle': (_pickle_dumps, pickle.loads),
+    'card': (_card_dumps, _card_loads), # the cards are small and must decode fast
+    'paper': (_paper_dumps, _paper_loads), # compact paper records, see PAPER_SCHEMAS
+}
+
+# the compressions. lz4 and zstd are optional, and only available if their packages
+# (lz4, zstandard) are installed. zstd compresses the small values of a table much
+# better with a dictionary trained on them, and a value records the id of the
+# dictionary it was compressed with, so the dictionaries are kept around forever
+
+class Compression:
+    """ a compression of the stored values, recorded in each value as its id byte """
+
+    def __init__(self, cid, compress, decompress):
+        self.cid = cid
+        self.compress = compress # (data, level, zdict) -> compressed bytes, level and zdict may be None
+        self.decompress = decompress # compressed bytes -> data
 
-class CompressedSqliteDict(SqliteDict):
-    """ overrides the encode/decode methods to use zlib, so we get compressed storage """
+COMPRESSION_IDS = {'none': 0, 'zlib': 1, 'lz4': 2, 'zstd': 3, 'zstd-dict': 3}
 
-    def __init__(self, *args, **kwargs):
+COMPRESSIONS = {
+    'none': Compression(0, lambda data, level, zdict: data, lambda data: data),
+    'zlib': Compression(1, lambda data, level, zdict: zlib.compress(data, -1 if level is None else level), zlib.decompress),
+}
 
-        def encode(obj):
-            return sqlite3.Binary(zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)))
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
-        def decode(obj):
-            return pickle.loads(zlib.decompress(bytes(obj)))
+if lz4 is not None:
+    def _lz4_compress(data, level, zdict):
+        if level is None:
+            return lz4.block.compress(data)
+        return lz4.block.compress(data, mode='high_compression', compression=level)
+    COMPRESSIONS['lz4'] = Compression(2, _lz4_compress, lz4.block.decompress)
 
-        super().__init__(*args, **kwargs, encode=encode, decode=decode)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the trained zstd dictionaries, as <table>.<dictionary id>.dict files
+ZSTD_DICT_DIR = os.path.join(DATA_DIR, 'zstd_dicts')
+
+_zstd_dicts = {} # dictionary id -> loaded dictionary
+_zstd_local = threading.local() # the zstd (de)compressor objects are not thread safe
+
+def _load_zstd_dict(path):
+    with open(path, 'rb') as f:
+        zdict = zstandard.ZstdCompressionDict(f.read())
+    _zstd_dicts[zdict.dict_id()] = zdict
+    return zdict
+
+def _zstd_dict(dict_id):
+    if dict_id not in _zstd_dicts:
+        paths = [os.path.join(ZSTD_DICT_DIR, f) for f in os.listdir(ZSTD_DICT_DIR) if f.endswith('.%d.dict' % dict_id)] \
+                if os.path.isdir(ZSTD_DICT_DIR) else []
+        if not paths:
+            raise ValueError('a value was compressed with zstd dictionary %d, which is not in %s' % (dict_id, ZSTD_DICT_DIR))
+        _load_zstd_dict(paths[0])
+    return _zstd_dicts[dict_id]
+
+def current_zstd_dict(tablename):
+    """ returns the newest zstd dictionary trained for a table, or None if there is none """
+    prefix = tablename + '.'
+    if zstandard is None or not os.path.isdir(ZSTD_DICT_DIR):
+        return None
+    paths = [os.path.join(ZSTD_DICT_DIR, f) for f in os.listdir(ZSTD_DICT_DIR) if f.startswith(prefix)]
+    if not paths:
+        return None
+    return _load_zstd_dict(max(paths, key=os.path.getmtime))
+
+def train_zstd_dict(tablename, samples, dict_size=64*1024, save=True):
+    """
+    trains a zstd dictionary on samples of the serialized values of a table and returns it.
+    if save, it is also saved as the dictionary that the table compresses with under
+    'zstd-dict' from now on, otherwise it only lives in this process, e.g. for benchmarks
+    """
+    zdict = zstandard.train_dictionary(dict_size, samples)
+    if save:
+        os.makedirs(ZSTD_DICT_DIR, exist_ok=True)
+        with open_atomic(os.path.join(ZSTD_DICT_DIR, '%s.%d.dict' % (tablename, zdict.dict_id())), 'wb') as f:
+            f.write(zdict.as_bytes())
+    _zstd_dicts[zdict.dict_id()] = zdict
+    return zdict
+
+if zstandard is not None:
+    def _zstd_compress(data, level, zdict):
+        cache = _zstd_local.__dict__.setdefault('compressors', {})
+        key = (level, zdict.dict_id() if zdict is not None else 0)
+        if key not in cache:
+            cache[key] = zstandard.ZstdCompressor(level=3 if level is None else level, dict_data=zdict)
+        return cache[key].compress(data)
+
+    def _zstd_decompress(data):
+        cache = _zstd_local.__dict__.setdefault('decompressors', {})
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        if dict_id not in cache:
+            cache[dict_id] = zstandard.ZstdDecompressor(dict_data=_zstd_dict(dict_id) if dict_id else None)
+        return cache[dict_id].decompress(data)
+
+    COMPRESSIONS['zstd'] = Compression(3, _zstd_compress, _zstd_decompress)
+    COMPRESSIONS['zstd-dict'] = COMPRESSIONS['zstd'] # the same, but with the table's dictionary
+
+_decompressors = {c.cid: c.decompress for c in COMPRESSIONS.values()}
+
+def decompress_value(obj):
+    """ returns the serialized bytes of a stored value, whichever compression it was written with """
+    data = bytes(obj)
+    cid = data[0]
+    if cid in _decompressors:
+        return _decompressors[cid](memoryview(data)[1:])
+    if cid in COMPRESSION_IDS.values():
+        names = ', '.join(n for n, i in COMPRESSION_IDS.items() if i == cid)
+        raise ValueError('a value was stored with %s compression, which is not installed' % (names, ))
+    if cid == 0x78:
+        return zlib.decompress(data) # from before the compression byte, when the big values were zlib
+    return data # and the rest were bare pickles
+
+# the compression of every table that isn't stored uncompressed, as 'name' or 'name:level'.
+# changing it only affects the values written from then on. e.g. 'zlib:1' compresses
+# faster, 'lz4' decompresses faster, and 'zstd-dict:3' packs the small values the
+# tightest once a dictionary was trained for the table (see bench_codecs.py)
+TABLE_COMPRESSION = {
+    'papers': 'zlib',
+    'tags': 'zlib',
+    'recommendations': 'zlib',
+}
+
+class Codec:
+    """ encodes the values of a table with a serializer and a compression, and decodes any of its values """
+
+    def __init__(self, serializer='pickle', compression='none', tablename=None, zdict=None):
+        self.dumps, self.loads = SERIALIZERS[serializer]
+        name, _, level = compression.partition(':')
+        if name not in COMPRESSIONS:
+            raise ValueError('unknown compression %s, the available ones are: %s' % (name, ', '.join(COMPRESSIONS)))
+        c = COMPRESSIONS[name]
+        self.cid = c.cid
+        self.level = int(level) if level else None
+        if name == 'zstd-dict' and zdict is None:
+            zdict = current_zstd_dict(tablename) # and plain zstd until one is trained
+        self.zdict = zdict if name == 'zstd-dict' else None
+        self._compress = c.compress
+        self._header = bytes([c.cid])
+
+    def encode(self, obj):
+        return sqlite3.Binary(self._header + self._compress(self.dumps(obj), self.level, self.zdict))
+
+    def decode(self, obj):
+        return self.loads(decompress_value(obj))
+
+def table_codec(tablename, serializer='pickle'):
+    """ the codec that the values of a table are written with """
+    return Codec(serializer, TABLE_COMPRESSION.get(tablename, 'none'), tablename)
+
+# -----------------------------------------------------------------------------
+"""
+connection pooling. every SqliteDict opens its own connection and spawns a thread
+that owns it, so instead of constructing them per request we keep one handle per
+(file, table, mode) per process and hand out that same handle every time.
+read-only handles skip sqlitedict altogether and use plain read-only sqlite
+connections, one per thread. all databases use WAL journaling, so these readers
+never block, and are never blocked by, the daemons writing to the same files.
+"""
+
+JOURNAL_MODE = 'WAL'
+BUSY_TIMEOUT = 30 # seconds to wait for a lock held by another process before erroring
+
+class PooledSqliteDict(SqliteDict):
+    """ a SqliteDict that lives in the pool: closing it (e.g. at the end of a with block) only commits """
+
+    def close(self, do_log=True, force=False):
+        if force:
+            super().close(do_log=do_log, force=force)
+        else:
+            self.commit()
+
+class SqliteReadDict:
+    """
+    a read-only, dict-like view of a table written by a SqliteDict, over plain
+    sqlite connections opened in read-only URI mode, one per thread. a table or
+    database file that doesn't exist yet simply reads as empty.
+    """
+
+    def __init__(self, filename, tablename, decode=sqlitedict.decode):
+        self.filename = filename
+        self.tablename = tablename.replace('"', '""')
+        self.decode = decode
+        self.encode_key = self.decode_key = lambda key: key # same as the SqliteDict defaults
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect('file:%s?mode=ro' % (self.filename, ), uri=True,
+                                   timeout=BUSY_TIMEOUT, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def select(self, query, args=()):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            cursor = self._conn().execute(query, args)
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                return
+            raise
+        yield from cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass # the connections stay open in the pool
+
+    def commit(self, blocking=True):
+        pass
+
+    def __len__(self):
+        rows = list(self.select('SELECT COUNT(*) FROM "%s"' % self.tablename))
+        return rows[0][0] if rows else 0
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, key):
+        return any(True for _ in self.select('SELECT 1 FROM "%s" WHERE key = ?' % self.tablename, (key, )))
+
+    def __getitem__(self, key):
+        for (value, ) in self.select('SELECT value FROM "%s" WHERE key = ?' % self.tablename, (key, )):
+            return self.decode(value)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for (key, ) in self.select('SELECT key FROM "%s" ORDER BY rowid' % self.tablename):
+            yield key
+
+    def values(self):
+        for (value, ) in self.select('SELECT value FROM "%s" ORDER BY rowid' % self.tablename):
+            yield self.decode(value)
+
+    def items(self):
+        for key, value in self.select('SELECT key, value FROM "%s" ORDER BY rowid' % self.tablename):
+            yield key, self.decode(value)
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+def open_db(filename, tablename, serializer='pickle', flag='c', autocommit=True):
+    """
+    returns a dict-like handle on a table. read-only and autocommit handles come from
+    the per-process pool. a handle with autocommit=False owns its transaction, so it
+    is never shared: the caller gets a fresh SqliteDict and is expected to close it.
+    the values are written with the table's codec, see TABLE_COMPRESSION.
+    """
+    assert flag in ['r', 'c']
+    codec = table_codec(tablename, serializer)
+    encode, decode = codec.encode, codec.decode
+    if flag == 'c' and not autocommit:
+        db = SqliteDict(filename, tablename=tablename, flag='c', autocommit=False,
+                        journal_mode=JOURNAL_MODE, encode=encode, decode=decode)
+        db.conn.execute('PRAGMA busy_timeout = %d' % (BUSY_TIMEOUT * 1000, ))
+        return db
+
+    # the pool is keyed by process too, handles must never be shared across a fork
+    key = (os.getpid(), filename, tablename, flag)
+    with _pool_lock:
+        if key not in _pool:
+            if flag == 'r':
+                db = SqliteReadDict(filename, tablename, decode=decode)
+            else:
+                db = PooledSqliteDict(filename, tablename=tablename, flag='c', autocommit=True,
+                                      journal_mode=JOURNAL_MODE, encode=encode, decode=decode)
+                db.conn.execute('PRAGMA busy_timeout = %d' % (BUSY_TIMEOUT * 1000, ))
+            _pool[key] = db
+        return _pool[key]
+
+def close_pool():
+    """ closes the pooled write handles of this process, committing anything outstanding """
+    with _pool_lock:
+        for key, db in list(_pool.items()):
+            if key[0] == os.getpid() and isinstance(db, PooledSqliteDict):
+                SqliteDict.close(db)
+                del _pool[key]
+
+atexit.register(close_pool)
+
+def get_many(db, keys, chunk_size=500):
+    """
+    fetches the values of many keys of a table with one SELECT ... IN (...)
+    query per chunk_size keys, instead of one query per key. returns a dict of
+    key -> value for the keys that exist.
+    """
+    select = db.select if isinstance(db, SqliteReadDict) else db.conn.select
+    keys = list(keys)
+    out = {}
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i+chunk_size]
+        query = 'SELECT key, value FROM "%s" WHERE key IN (%s)' % (db.tablename, ','.join('?' * len(chunk)))
+        for k, v in select(query, [db.encode_key(k) for k in chunk]):
+            out[db.decode_key(k)] = db.decode(v)
+    return out
+
+def rowid_ranges(db, chunk_size):
+    """
+    splits the rows of a table into contiguous (lo, hi) rowid ranges of at most
+    chunk_size rows each, in rowid (i.e. insertion) order, so that the table can
+    be scanned in independent chunks, e.g. by different processes
+    """
+    select = db.select if isinstance(db, SqliteReadDict) else db.conn.select
+    rowids = [r for (r, ) in select('SELECT rowid FROM "%s" ORDER BY rowid' % db.tablename)]
+    return [(rowids[i], rowids[min(i + chunk_size, len(rowids)) - 1]) for i in range(0, len(rowids), chunk_size)]
+
+def iter_rowid_range(db, lo, hi):
+    """ yields the (key, value) pairs of the rows with lo <= rowid <= hi, in rowid order """
+    select = db.select if isinstance(db, SqliteReadDict) else db.conn.select
+    query = 'SELECT key, value FROM "%s" WHERE rowid BETWEEN ? AND ? ORDER BY rowid' % db.tablename
+    for k, v in select(query, (lo, hi)):
+        yield db.decode_key(k), db.decode(v)
 
 # -----------------------------------------------------------------------------
 """
@@ -104,45 +514,478 @@ PAPERS_DB_FILE = os.path.join(DATA_DIR, 'papers.db')
 # stores account-relevant info, like which tags exist for which papers
 DICT_DB_FILE = os.path.join(DATA_DIR, 'dict.db')
 
+# the fields of a stored paper record, by version of the schema. the record keeps only
+# what we actually read, authors as their names and tags as their terms, and decodes
+# back to the same dict as always, with _idv rebuilt and the authors/tags as dicts.
+# the records written before there was a schema are whole feedparser dicts, and
+# decode as they are until migrate_papers.py rewrites them.
+PAPER_SCHEMAS = {
+    1: ['_id', '_version', '_time', '_time_str', 'title', 'summary', 'authors', 'tags', 'link', 'llm_summary'],
+}
+PAPER_SCHEMA = 1 # the version new records are written in
+
 def get_papers_db(flag='c', autocommit=True):
-    assert flag in ['r', 'c']
-    pdb = CompressedSqliteDict(PAPERS_DB_FILE, tablename='papers', flag=flag, autocommit=autocommit)
-    return pdb
+    return open_db(PAPERS_DB_FILE, 'papers', serializer='paper', flag=flag, autocommit=autocommit)
 
 def get_metas_db(flag='c', autocommit=True):
-    assert flag in ['r', 'c']
-    mdb = SqliteDict(PAPERS_DB_FILE, tablename='metas', flag=flag, autocommit=autocommit)
-    return mdb
+    return open_db(PAPERS_DB_FILE, 'metas', flag=flag, autocommit=autocommit)
+
+def get_cards_db(flag='c', autocommit=True):
+    return open_db(PAPERS_DB_FILE, 'cards', serializer='card', flag=flag, autocommit=autocommit)
 
 def get_tags_db(flag='c', autocommit=True):
-    assert flag in ['r', 'c']
-    tdb = CompressedSqliteDict(DICT_DB_FILE, tablename='tags', flag=flag, autocommit=autocommit)
-    return tdb
+    return open_db(DICT_DB_FILE, 'tags', flag=flag, autocommit=autocommit)
 
 def get_last_active_db(flag='c', autocommit=True):
-    assert flag in ['r', 'c']
-    ladb = SqliteDict(DICT_DB_FILE, tablename='last_active', flag=flag, autocommit=autocommit)
-    return ladb
+    return open_db(DICT_DB_FILE, 'last_active', flag=flag, autocommit=autocommit)
 
 def get_email_db(flag='c', autocommit=True):
+    return open_db(DICT_DB_FILE, 'email', flag=flag, autocommit=autocommit)
+
+def get_recommendations_db(flag='c', autocommit=True):
+    return open_db(DICT_DB_FILE, 'recommendations', flag=flag, autocommit=autocommit)
+
+REC_TIME_DELTA = 30 # by default the recommendations are of the papers of the last this many days
+
+def tags_fingerprint(tags):
+    """ a short hash of a user's tags dict, to tell if they changed since something was computed from them """
+    h = hashlib.sha1()
+    for tag in sorted(tags):
+        h.update(('%s\0%s\n' % (tag, '\0'.join(sorted(tags[tag])))).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+class LastActiveBuffer:
+    """
+    write-behind buffer for the last_active table. the web server touches a user on
+    every request, so instead of a write transaction per request we coalesce the
+    timestamps in memory and write them all in one transaction, either every
+    flush_interval seconds from a background thread, as soon as max_pending users
+    are waiting, or when the process exits normally. the timestamps are rounded
+    down to granularity seconds, so repeated requests mostly don't dirty anything.
+    """
+
+    def __init__(self, flush_interval=60, max_pending=500, granularity=60):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.granularity = granularity
+        self.pending = {} # user -> last active time, not yet written
+        self.lock = threading.Lock()
+        self._thread_pid = None # the process that owns the flush thread, in case we get forked
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def touch(self, user):
+        t = int(time.time()) // self.granularity * self.granularity
+        with self.lock:
+            if self.pending.get(user) == t:
+                return
+            self.pending[user] = t
+            full = len(self.pending) >= self.max_pending
+            if self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                threading.Thread(target=self._flush_loop, daemon=True).start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        with get_last_active_db(flag='c', autocommit=False) as ladb:
+            ladb.update(batch)
+            ladb.commit()
+
+# -----------------------------------------------------------------------------
+"""
+a "card" is the few fields of a paper that the list views and emails show, pre-rendered
+to strings. they live in their own table in papers.db so that rendering a list never
+has to decompress the full paper records.
+"""
+
+CARD_FIELDS = ['id', 'title', 'time', 'authors', 'tags', 'summary']
+
+def paper_to_card(p):
+    """ renders the card of a full paper record """
+    return {
+        'id': p['_id'],
+        'title': p['title'],
+        'time': p['_time_str'],
+        'authors': ', '.join(a['name'] for a in p['authors']),
+        'tags': ', '.join(t['term'] for t in p['tags']),
+        'summary': p['summary'],
+    }
+
+def fetch_cards(cdb, pids, pdb=None):
+    """
+    fetches the cards of the given pids as a dict pid -> card. papers that were stored
+    before the cards table existed have their card rendered from the full record instead
+    """
+    cards = get_many(cdb, pids)
+    missing = [pid for pid in pids if pid not in cards]
+    if missing:
+        pdb = pdb if pdb is not None else get_papers_db(flag='r')
+        for pid, p in get_many(pdb, missing).items():
+            cards[pid] = paper_to_card(p)
+    return cards
+
+# -----------------------------------------------------------------------------
+"""
+batch writes of new papers. a paper lives in three tables of papers.db (papers,
+metas, cards), and each SqliteDict has its own connection, so instead we write a
+whole batch of papers into all three over one plain connection in one transaction.
+"""
+
+# the schema of every sqlitedict table
+MAKE_TABLE = 'CREATE TABLE IF NOT EXISTS "%s" (key TEXT PRIMARY KEY, value BLOB)'
+
+def _batch_conn(filename):
+    """ returns this process's connection for batch writes into filename, opened on first use """
+    key = (os.getpid(), filename, None, 'batch')
+    with _pool_lock:
+        if key not in _pool:
+            conn = sqlite3.connect(filename, isolation_level=None, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = %s' % (JOURNAL_MODE, ))
+            for table in ['papers', 'metas', 'cards']:
+                conn.execute(MAKE_TABLE % table)
+            _pool[key] = conn
+        return _pool[key]
+
+def upsert_papers(papers, chunk_size=500):
+    """
+    stores a batch of paper records, together with their metas and cards, in a single
+    transaction. a paper we already have is only overwritten if the new record has a
+    newer _time, which is checked against the metas table with one query per chunk_size
+    papers, so the stored records never have to be decompressed for it.
+    returns the lists of the papers that were new, and of those that replaced older ones.
+    """
+    # if a paper comes more than once, its newest record wins
+    latest = {}
+    for p in papers:
+        if p['_id'] not in latest or p['_time'] > latest[p['_id']]['_time']:
+            latest[p['_id']] = p
+    pids = list(latest)
+
+    encode_paper = table_codec('papers', 'paper').encode
+    encode_card = table_codec('cards', 'card').encode
+    meta_codec = table_codec('metas')
+    encode_meta, decode_meta = meta_codec.encode, meta_codec.decode
+    conn = _batch_conn(PAPERS_DB_FILE)
+    conn.execute('BEGIN IMMEDIATE') # take the write lock now, so the freshness check can't go stale
+    try:
+        times = {}
+        for i in range(0, len(pids), chunk_size):
+            chunk = pids[i:i+chunk_size]
+            query = 'SELECT key, value FROM metas WHERE key IN (%s)' % (','.join('?' * len(chunk)), )
+            for k, v in conn.execute(query, chunk):
+                times[k] = decode_meta(v)['_time']
+        new = [latest[pid] for pid in pids if pid not in times]
+        replaced = [latest[pid] for pid in pids if pid in times and latest[pid]['_time'] > times[pid]]
+        stored = new + replaced
+        conn.executemany('REPLACE INTO papers (key, value) VALUES (?, ?)',
+                         [(p['_id'], encode_paper(p)) for p in stored])
+        conn.executemany('REPLACE INTO metas (key, value) VALUES (?, ?)',
+                         [(p['_id'], encode_meta({'_time': p['_time']})) for p in stored])
+        conn.executemany('REPLACE INTO cards (key, value) VALUES (?, ?)',
+                         [(p['_id'], encode_card(paper_to_card(p))) for p in stored])
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return new, replaced
+
+# -----------------------------------------------------------------------------
+"""
+the time index is a compact, precomputed copy of the metas table sorted by _time,
+so that time ranking, time filtering and pagination are binary searches and slices
+"""
+
+# stores a structured numpy array of (pid, _time), sorted from oldest to newest
+TIME_INDEX_FILE = os.path.join(DATA_DIR, 'time_index.npy')
+
+class TimeIndex:
+    """ all pids and their _time as two parallel arrays, sorted from oldest to newest """
+
+    def __init__(self, arr):
+        self.pids = arr['pid']
+        self.times = arr['time']
+
+    @classmethod
+    def from_metas(cls, metas):
+        """ builds the index from an iterable of (pid, meta) pairs, e.g. mdb.items() """
+        kv = [(pid, m['_time']) for pid, m in metas]
+        width = max((len(pid) for pid, t in kv), default=1)
+        arr = np.array(kv, dtype=[('pid', 'U%d' % (width, )), ('time', np.float64)])
+        arr.sort(order='time', kind='stable')
+        return cls(arr)
+
+    def __len__(self):
+        return len(self.times)
+
+    def since(self, tmin):
+        """ returns the position of the first paper with _time strictly greater than tmin """
+        return int(np.searchsorted(self.times, tmin, side='right'))
+
+    def save(self, fname):
+        arr = np.empty(len(self), dtype=[('pid', self.pids.dtype), ('time', np.float64)])
+        arr['pid'], arr['time'] = self.pids, self.times
+        with open_atomic(fname, 'wb') as f:
+            np.save(f, arr)
+
+def save_time_index(metas):
+    """ rebuilds the time index from an iterable of (pid, meta) pairs and saves it to disk """
+    TimeIndex.from_metas(metas).save(TIME_INDEX_FILE)
+
+def load_time_index():
+    """ memory-maps the time index, so processes share one copy in the page cache """
+    return TimeIndex(np.load(TIME_INDEX_FILE, mmap_mode='r'))
+
+_time_index_cache = FileCache(TIME_INDEX_FILE, lambda version: load_time_index())
+
+def current_time_index():
+    """ returns the latest TimeIndex, or None if arxiv_daemon.py has not written one yet """
+    if not os.path.isfile(TIME_INDEX_FILE):
+        return None
+    return _time_index_cache.get()
+
+# -----------------------------------------------------------------------------
+"""
+the search index is an inverted index in its own sqlite file, see aslite/search.py.
+compute.py rebuilds it from scratch and arxiv_daemon.py keeps it up to date in between.
+"""
+
+# stores the postings of every term in the title, authors and abstract of every paper
+SEARCH_DB_FILE = os.path.join(DATA_DIR, 'search.db')
+
+def get_search_index(flag='r'):
+    """ opens the search index, or returns None if flag='r' and it has not been built yet """
     assert flag in ['r', 'c']
-    edb = SqliteDict(DICT_DB_FILE, tablename='email', flag=flag, autocommit=autocommit)
-    return edb
+    if flag == 'r' and not os.path.isfile(SEARCH_DB_FILE):
+        return None
+    return SearchIndex(SEARCH_DB_FILE, flag=flag)
+
+def save_search_index(papers):
+    """ builds a fresh search index over an iterable of papers and atomically swaps it in """
+    with _tempfile(dir=DATA_DIR, suffix='.db') as tmppath:
+        with SearchIndex(tmppath, flag='c') as index:
+            index.add(papers)
+            index.commit()
+        os.rename(tmppath, SEARCH_DB_FILE)
 
 # -----------------------------------------------------------------------------
 """
-our "feature store" is currently just a pickle file, may want to consider hdf5 in the future
+our "feature store" is a directory of plain .npy arrays that every process can
+memory map, so they all share one copy of the features in the page cache. each
+version gets its own directory, and the FEATURES_DIR symlink is atomically
+swapped over to the newest one once it is complete.
 """
 
-# stores tfidf features a bunch of other metadata
-FEATURES_FILE = os.path.join(DATA_DIR, 'features.p')
+# symlink to the current version of the tfidf features and a bunch of other metadata
+FEATURES_DIR = os.path.join(DATA_DIR, 'features')
+FEATURES_KEEP = 2 # number of versions kept around, for readers still on an older one
+# the single pickle file that the features were saved to before there was a feature store.
+# it is still read as long as compute.py hasn't written the store, e.g. right after an upgrade
+LEGACY_FEATURES_FILE = os.path.join(DATA_DIR, 'features.p')
+
+def _file_crc32(path, block_size=2**20):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
 
 def save_features(features):
-    """ takes the features dict and save it to disk in a simple pickle file """
-    safe_pickle_dump(features, FEATURES_FILE)
+    """
+    takes the features dict and saves it to disk as a new version of the feature
+    store: the csr matrix 'x' as its data/indices/indptr arrays, the 'pids' and
+    the 'vocab' (in column order) as string arrays, any other numpy arrays as
+    they are, and everything else (plain numbers and strings) in the manifest.
+    """
+    version = '%016x' % time.time_ns()
+    arrays, meta = {}, {}
+    for k, v in features.items():
+        if k == 'x':
+            arrays.update({'x_data': v.data, 'x_indices': v.indices, 'x_indptr': v.indptr})
+            meta['x_shape'] = list(v.shape)
+        elif k == 'pids':
+            arrays['pids'] = np.array(v, dtype=str)
+        elif k == 'vocab':
+            words = [None] * len(v)
+            for w, i in v.items():
+                words[i] = w
+            arrays['vocab'] = np.array(words, dtype=str)
+        elif isinstance(v, np.ndarray):
+            arrays[k] = v
+        else:
+            meta[k] = v
+
+    # write the new version out next to the old ones, under a name no reader will look at
+    vdir = FEATURES_DIR + '.' + version
+    tmpdir = vdir + '.tmp'
+    os.makedirs(tmpdir)
+    files = {}
+    for k, a in arrays.items():
+        path = os.path.join(tmpdir, k + '.npy')
+        np.save(path, np.ascontiguousarray(a))
+        files[k] = {'size': os.path.getsize(path), 'crc32': _file_crc32(path)}
+    manifest = {'version': version, 'files': files, 'meta': meta}
+    with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmpdir, vdir)
+
+    # publish it by atomically repointing the symlink
+    tmplink = vdir + '.link'
+    os.symlink(os.path.basename(vdir), tmplink)
+    os.rename(tmplink, FEATURES_DIR)
+
+    # the readers that mapped an older version keep their (unlinked) files until they reload
+    prefix = os.path.basename(FEATURES_DIR) + '.'
+    versions = sorted(d for d in os.listdir(DATA_DIR) if d.startswith(prefix) and len(d) == len(prefix) + len(version))
+    for d in versions[:-FEATURES_KEEP]:
+        shutil.rmtree(os.path.join(DATA_DIR, d), ignore_errors=True)
+
+def load_features(verify=False):
+    """
+    loads the current version of the features dict from disk, with all of its
+    arrays memory mapped. the files are always checked against the sizes in the
+    manifest, and also against their checksums if verify=True.
+    """
+    if not os.path.exists(FEATURES_DIR) and os.path.isfile(LEGACY_FEATURES_FILE):
+        return load_legacy_features()
+    vdir = os.path.realpath(FEATURES_DIR) # pin the version, even if it is swapped underneath us
+    with open(os.path.join(vdir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    arrays = {}
+    for k, info in manifest['files'].items():
+        path = os.path.join(vdir, k + '.npy')
+        if os.path.getsize(path) != info['size'] or (verify and _file_crc32(path) != info['crc32']):
+            raise ValueError('feature file %s does not match the manifest of version %s' % (path, manifest['version']))
+        arrays[k] = np.load(path, mmap_mode='r')
+
+    meta = dict(manifest['meta'])
+    features = {'version': manifest['version']}
+    features['x'] = sp.csr_matrix((arrays.pop('x_data'), arrays.pop('x_indices'), arrays.pop('x_indptr')),
+                                  shape=tuple(meta.pop('x_shape')), copy=False)
+    features['pids'] = arrays.pop('pids').tolist()
+    features['vocab'] = {w: i for i, w in enumerate(arrays.pop('vocab').tolist())}
+    features.update(arrays)
+    features.update(meta)
+    return features
+
+class Features:
+    """
+    an immutable snapshot of the features dict, together with the lookup
+    tables that the rankers need, built once when the snapshot is loaded
+    """
+
+    def __init__(self, features, version):
+        self.version = version
+        self.store_version = features.get('version') # version id in the feature store manifest
+        self.x = features['x'] # (n, d) sparse csr matrix of tfidf features, memory mapped
+        self.pids = features['pids'] # row index -> pid
+        self.vocab = features['vocab'] # word -> column index
+        self.idf = features['idf']
+        # optional (n, k) nearest neighbor rows and cosine similarities of every row, best first
+        self.knn_ix = features.get('knn_ix')
+        self.knn_sim = features.get('knn_sim')
+        # optional (n, r) dense low-rank projection of x, and the (r, d) components that map it back to the words
+        self.lsa = features.get('lsa')
+        self.lsa_components = features.get('lsa_components')
+        self.ptoi = {p: i for i, p in enumerate(self.pids)} # pid -> row index
+        if self.vocab:
+            self.ivocab = [None] * len(self.vocab) # column index -> word
+            for w, i in self.vocab.items():
+                self.ivocab[i] = w
+        else:
+            self.ivocab = HashedVocab() # hashed features have no vocabulary
 
-def load_features():
-    """ loads the features dict from disk """
-    with open(FEATURES_FILE, 'rb') as f:
+class HashedVocab:
+    """ stands in for the column index -> word list of hashed features """
+
+    def __getitem__(self, i):
+        return '#%d' % i
+
+def load_legacy_features():
+    """ loads the features dict from the pickle file of before the feature store, versioned by its mtime """
+    with open(LEGACY_FEATURES_FILE, 'rb') as f:
         features = pickle.load(f)
+    features['version'] = '%016x' % os.stat(LEGACY_FEATURES_FILE).st_mtime_ns
     return features
+
+_features_cache = FileCache(FEATURES_DIR, lambda version: Features(load_features(), version))
+_legacy_features_cache = FileCache(LEGACY_FEATURES_FILE, lambda version: Features(load_legacy_features(), version))
+
+def current_features():
+    """ returns the latest Features snapshot, loaded at most once per process per version """
+    if not os.path.exists(FEATURES_DIR) and os.path.isfile(LEGACY_FEATURES_FILE):
+        return _legacy_features_cache.get() # until compute.py writes the feature store for the first time
+    return _features_cache.get()
+
+# -----------------------------------------------------------------------------
+"""
+every run of send_emails.py keeps a checkpoint of the users it is done with,
+so that a run that dies halfway can be resumed without emailing anyone twice
+"""
+
+class RunCheckpoint:
+    """ an append-only log of user -> status, one json line per user, synced on every write """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        continue # a line torn by a crash, that user just wasn't done
+                    self.done[r['user']] = r['status']
+        self._f = open(filename, 'a')
+        self._lock = threading.Lock() # the mailer marks users from its threads
+        if self._f.tell() > 0:
+            self._f.write('\n') # so a torn last line can't swallow the next record
+
+    def __contains__(self, user):
+        return user in self.done
+
+    def mark(self, user, status):
+        with self._lock:
+            self._f.write(json.dumps({'user': user, 'status': status, 'time': time.time()}) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self.done[user] = status
+
+    def close(self):
+        self._f.close()
+
+def get_email_checkpoint(run_id):
+    return RunCheckpoint(os.path.join(DATA_DIR, 'email_run_%s.jsonl' % (run_id, )))
+
+# -----------------------------------------------------------------------------
+"""
+the cursors of the long running ingests, i.e. where they are at in their input,
+so that an arxiv_daemon.py backfill or an import_snapshot.py run that gets
+interrupted can resume from where it stopped
+"""
+
+CURSOR_FILE = os.path.join(DATA_DIR, '%s_cursor.json') # by the name of the ingest, e.g. 'arxiv'
+
+def save_cursor(name, cursor):
+    with open_atomic(CURSOR_FILE % (name, ), 'w', fsync=True) as f:
+        json.dump(cursor, f)
+
+def load_cursor(name):
+    """ returns the saved cursor dict, or None if there is none """
+    if not os.path.isfile(CURSOR_FILE % (name, )):
+        return None
+    with open(CURSOR_FILE % (name, )) as f:
+        return json.load(f)
+
+def clear_cursor(name):
+    if os.path.isfile(CURSOR_FILE % (name, )):
+        os.remove(CURSOR_FILE % (name, ))
@@ -0,0 +1,212 @@
+"""
+Transports that deliver the recommendation emails, and a Mailer that sends
+through any of them from a few threads at once, rate limited and with retries.
+The transports are initialized once and keep their connections open, one per
+sending thread, instead of reconnecting for every email.
+"""
+
+import os
+import json
+import time
+import random
+import smtplib
+import logging
+import threading
+import http.client
+from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor
+
+from aslite.ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+FROM_EMAIL = 'admin@arxiv-sanity-lite.com'
+
+class TransientError(Exception):
+    """ a send that failed in a way that is worth retrying: throttling, server errors, network trouble """
+
+# -----------------------------------------------------------------------------
+# transports. all of them are safe to use from many threads at once
+
+class Transport:
+
+    def send(self, to, subject, html):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class NullTransport(Transport):
+    """ sends nothing, for dry runs """
+
+    def send(self, to, subject, html):
+        pass
+
+class SendGridTransport(Transport):
+    """
+    posts to the SendGrid v3 mail send API over a keep-alive https connection per
+    thread. SendGrid can only batch recipients that share one body (many
+    personalizations per request), and every one of our emails is different, so
+    each email is its own request and the throughput comes from the concurrency.
+    """
+
+    HOST = 'api.sendgrid.com'
+    PATH = '/v3/mail/send'
+
+    def __init__(self, api_key, from_email=FROM_EMAIL, timeout=30):
+        self.headers = {
+            'Authorization': 'Bearer ' + api_key,
+            'Content-Type': 'application/json',
+        }
+        self.from_email = from_email
+        self.timeout = timeout
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPSConnection(self.HOST, timeout=self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def send(self, to, subject, html):
+        body = json.dumps({
+            'personalizations': [{'to': [{'email': to}]}],
+            'from': {'email': self.from_email},
+            'subject': subject,
+            'content': [{'type': 'text/html', 'value': html}],
+        }).encode('utf-8')
+        conn = self._conn()
+        try:
+            conn.request('POST', self.PATH, body=body, headers=self.headers)
+            response = conn.getresponse()
+            detail = response.read() # always drain the response, so the connection can be reused
+        except (OSError, http.client.HTTPException) as e:
+            conn.close() # it reconnects on the next request
+            raise TransientError('sendgrid request failed: %s' % (e, ))
+        if response.status == 429 or response.status >= 500:
+            raise TransientError('sendgrid returned %d: %s' % (response.status, detail[:200]))
+        if response.status >= 300:
+            raise RuntimeError('sendgrid returned %d: %s' % (response.status, detail[:200]))
+
+    def close(self):
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+class SMTPTransport(Transport):
+    """ sends over one persistent smtp session per thread, e.g. to a local smtp sink for load tests """
+
+    def __init__(self, host='localhost', port=1025, from_email=FROM_EMAIL, timeout=30):
+        self.host = host
+        self.port = port
+        self.from_email = from_email
+        self.timeout = timeout
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def send(self, to, subject, html):
+        msg = make_message(self.from_email, to, subject, html)
+        try:
+            self._conn().send_message(msg)
+        except smtplib.SMTPResponseException as e:
+            if 400 <= e.smtp_code < 500:
+                raise TransientError('smtp server returned %d' % (e.smtp_code, ))
+            raise
+        except (OSError, smtplib.SMTPServerDisconnected) as e:
+            self._local.conn = None # reconnect on the next try
+            raise TransientError('smtp send failed: %s' % (e, ))
+
+    def close(self):
+        with self._lock:
+            for conn in self._conns:
+                try:
+                    conn.quit()
+                except (OSError, smtplib.SMTPException):
+                    pass
+            self._conns = []
+
+class FileTransport(Transport):
+    """ writes every email as an .eml file into a directory, to run the whole pipeline offline """
+
+    def __init__(self, outdir, from_email=FROM_EMAIL):
+        self.outdir = outdir
+        self.from_email = from_email
+        os.makedirs(outdir, exist_ok=True)
+
+    def send(self, to, subject, html):
+        msg = make_message(self.from_email, to, subject, html)
+        name = '%s-%d.eml' % (to.replace(os.sep, '_'), time.time_ns())
+        with open(os.path.join(self.outdir, name), 'wb') as f:
+            f.write(msg.as_bytes())
+
+def make_message(from_email, to, subject, html):
+    msg = EmailMessage()
+    msg['From'] = from_email
+    msg['To'] = to
+    msg['Subject'] = subject
+    msg.set_content(html, subtype='html')
+    return msg
+
+# -----------------------------------------------------------------------------
+
+class Mailer:
+    """
+    sends emails through a transport from a pool of threads, at most rate emails
+    per second, retrying transient failures with jittered exponential backoff.
+    submit() blocks once 2 * concurrency emails are waiting, so the caller can't
+    render arbitrarily far ahead of the sending.
+    """
+
+    def __init__(self, transport, concurrency=4, rate=0, retries=3, backoff=1.0):
+        self.transport = transport
+        self.limiter = RateLimiter(rate, burst=max(1, concurrency))
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='mailer')
+        self._slots = threading.BoundedSemaphore(2 * concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, to, subject, html):
+        """ queues an email, returns a Future that is done once it is sent, or raises if it finally failed """
+        self._slots.acquire()
+        future = self._executor.submit(self._send, to, subject, html)
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _send(self, to, subject, html):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                return self.transport.send(to, subject, html)
+            except TransientError as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+                logger.warning("sending to %s failed (%s), retrying in %.1fs", to, e, delay)
+                time.sleep(delay)
+
+    def close(self):
+        """ waits for all the queued emails to go out, then closes the transport """
+        self._executor.shutdown(wait=True)
+        self.transport.close()
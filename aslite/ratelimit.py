@@ -0,0 +1,30 @@
+"""
+A token bucket rate limiter, shared by anything that has to pace itself against
+an external service, e.g. the arxiv api or the email provider.
+"""
+
+import time
+import threading
+
+class RateLimiter:
+    """ a token bucket that lets rate calls per second through on average, in bursts of up to burst """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return # no limit
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            # take the token now even if it's not there yet, and wait until it would have been
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
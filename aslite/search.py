@@ -0,0 +1,139 @@
+"""
+A persistent inverted index over the title, authors and abstract of the papers.
+It lives in its own sqlite file, with one posting row per (term, paper) that
+holds the term frequency in each field. Queries are scored with BM25F and only
+ever touch the postings of the query terms, never the full papers table.
+"""
+
+import re
+import math
+import sqlite3
+import unicodedata
+from collections import Counter
+
+# -----------------------------------------------------------------------------
+# scoring configuration
+
+FIELDS = ['title', 'authors', 'summary']
+FIELD_WEIGHTS = {'title': 4.0, 'authors': 4.0, 'summary': 1.0} # a title/author hit counts more
+FIELD_B = {'title': 0.75, 'authors': 0.5, 'summary': 0.75} # per-field length normalization
+K1 = 1.2 # term frequency saturation
+
+# -----------------------------------------------------------------------------
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+def tokenize(s):
+    """ lowercase, strip accents and split into alphanumeric tokens """
+    s = unicodedata.normalize('NFKD', s.lower())
+    return TOKEN_RE.findall(s.encode('ascii', 'ignore').decode('ascii'))
+
+def paper_fields(p):
+    """ extract the text of each indexed field of a paper dict """
+    return {
+        'title': p['title'],
+        'authors': ' '.join(a['name'] for a in p['authors']),
+        'summary': p['summary'],
+    }
+
+# -----------------------------------------------------------------------------
+
+class SearchIndex:
+    """ the inverted index, backed by a single sqlite file """
+
+    def __init__(self, filename, flag='r'):
+        assert flag in ['r', 'c']
+        self.filename = filename
+        if flag == 'r':
+            # read-only, and fail loudly if the index has not been built yet
+            self.conn = sqlite3.connect('file:%s?mode=ro' % (filename, ), uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(filename, check_same_thread=False)
+            self._create_tables()
+
+    def _create_tables(self):
+        c = self.conn
+        c.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT, pid TEXT, '
+                  'tf_title INTEGER, tf_authors INTEGER, tf_summary INTEGER, '
+                  'PRIMARY KEY (term, pid)) WITHOUT ROWID')
+        c.execute('CREATE INDEX IF NOT EXISTS postings_pid ON postings (pid)')
+        c.execute('CREATE TABLE IF NOT EXISTS docs (pid TEXT PRIMARY KEY, '
+                  'len_title INTEGER, len_authors INTEGER, len_summary INTEGER)')
+        # running totals, so queries never have to aggregate over the docs table
+        c.execute('CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER)')
+        c.executemany('INSERT OR IGNORE INTO totals VALUES (?, 0)',
+                      [('ndocs', )] + [('len_' + f, ) for f in FIELDS])
+        c.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._totals()['ndocs']
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def _totals(self):
+        return dict(self.conn.execute('SELECT name, value FROM totals'))
+
+    def remove(self, pid):
+        """ drop a paper from the index, if it is in there """
+        c = self.conn
+        row = c.execute('SELECT len_title, len_authors, len_summary FROM docs WHERE pid = ?', (pid, )).fetchone()
+        if row is None:
+            return
+        c.execute('DELETE FROM postings WHERE pid = ?', (pid, ))
+        c.execute('DELETE FROM docs WHERE pid = ?', (pid, ))
+        c.execute("UPDATE totals SET value = value - 1 WHERE name = 'ndocs'")
+        for f, n in zip(FIELDS, row):
+            c.execute('UPDATE totals SET value = value - ? WHERE name = ?', (n, 'len_' + f))
+
+    def add(self, papers):
+        """ index (or re-index) an iterable of paper dicts, the caller commits """
+        c = self.conn
+        for p in papers:
+            pid = p['_id']
+            self.remove(pid)
+            tfs = {f: Counter(tokenize(s)) for f, s in paper_fields(p).items()}
+            lens = [sum(tfs[f].values()) for f in FIELDS]
+            terms = set().union(*tfs.values())
+            c.executemany('INSERT INTO postings VALUES (?, ?, ?, ?, ?)',
+                          [(t, pid, tfs['title'][t], tfs['authors'][t], tfs['summary'][t]) for t in terms])
+            c.execute('INSERT INTO docs VALUES (?, ?, ?, ?)', (pid, *lens))
+            c.execute("UPDATE totals SET value = value + 1 WHERE name = 'ndocs'")
+            for f, n in zip(FIELDS, lens):
+                c.execute('UPDATE totals SET value = value + ? WHERE name = ?', (n, 'len_' + f))
+
+    def score(self, q):
+        """ returns a dict of pid -> BM25F score for all papers matching query q """
+        terms = set(tokenize(q))
+        totals = self._totals()
+        ndocs = totals['ndocs']
+        if not terms or ndocs == 0:
+            return {}
+        avglen = {f: max(1.0, totals['len_' + f] / ndocs) for f in FIELDS}
+
+        scores = {}
+        for t in terms:
+            rows = self.conn.execute(
+                'SELECT p.pid, p.tf_title, p.tf_authors, p.tf_summary, '
+                'd.len_title, d.len_authors, d.len_summary '
+                'FROM postings p JOIN docs d ON d.pid = p.pid WHERE p.term = ?', (t, )).fetchall()
+            if not rows:
+                continue
+            idf = math.log(1.0 + (ndocs - len(rows) + 0.5) / (len(rows) + 0.5))
+            for pid, *r in rows:
+                # combine the length-normalized field frequencies, then saturate once
+                tf = 0.0
+                for f, tf_f, len_f in zip(FIELDS, r[:3], r[3:]):
+                    if tf_f:
+                        tf += FIELD_WEIGHTS[f] * tf_f / (1.0 - FIELD_B[f] + FIELD_B[f] * len_f / avglen[f])
+                scores[pid] = scores.get(pid, 0.0) + idf * tf / (K1 + tf)
+        return scores
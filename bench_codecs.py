@@ -0,0 +1,95 @@
+"""
+Benchmarks the storage codecs of a table on our own data: writes all of its values
+into a scratch database with every compression, then reports the size on disk, the
+latency of reading single values by key, and the throughput of scanning them all.
+lz4 and zstd are only benchmarked if their packages are installed. With --save-dict
+the zstd dictionary trained here is kept as the table's dictionary, so that the
+table can be switched to 'zstd-dict' in TABLE_COMPRESSION of aslite/db.py.
+"""
+
+import os
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+import numpy as np
+
+from aslite.db import PAPERS_DB_FILE, DICT_DB_FILE, MAKE_TABLE, SERIALIZERS, COMPRESSIONS
+from aslite.db import Codec, table_codec, train_zstd_dict
+
+# the tables worth benchmarking: table -> (database file, serializer)
+TABLES = {
+    'papers': (PAPERS_DB_FILE, 'paper'),
+    'cards': (PAPERS_DB_FILE, 'card'),
+    'tags': (DICT_DB_FILE, 'pickle'),
+    'recommendations': (DICT_DB_FILE, 'pickle'),
+}
+
+def bench(name, codec, items, keys, tmpdir):
+    fname = os.path.join(tmpdir, name.replace(':', '_') + '.db')
+    conn = sqlite3.connect(fname, isolation_level=None)
+    conn.execute(MAKE_TABLE % 'bench')
+    conn.execute('BEGIN')
+    t0 = time.perf_counter()
+    conn.executemany('INSERT INTO bench (key, value) VALUES (?, ?)', [(k, codec.encode(v)) for k, v in items])
+    twrite = time.perf_counter() - t0
+    conn.execute('COMMIT')
+    conn.execute('VACUUM')
+    size = os.path.getsize(fname)
+
+    # single reads by key, e.g. one paper of a page being rendered
+    lat = []
+    for k in keys:
+        t0 = time.perf_counter()
+        codec.decode(conn.execute('SELECT value FROM bench WHERE key = ?', (k, )).fetchone()[0])
+        lat.append(time.perf_counter() - t0)
+    lat = np.array(lat) * 1e6
+
+    # a full scan, e.g. compute.py reading all the papers
+    t0 = time.perf_counter()
+    n = sum(1 for (v, ) in conn.execute('SELECT value FROM bench') if codec.decode(v) is not None)
+    tscan = time.perf_counter() - t0
+    conn.close()
+    print("%-12s %8.2f MB %8.1f us %8.1f us %10.0f /s %10.0f /s" %
+          (name, size / 1e6, np.median(lat), np.percentile(lat, 99), n / tscan, len(items) / twrite))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the storage codecs on the values of a table')
+    parser.add_argument('-t', '--table', type=str, default='papers', choices=list(TABLES), help='which table to take the values from')
+    parser.add_argument('-n', '--num', type=int, default=0, help='use at most this many values, or 0 for all of them')
+    parser.add_argument('-r', '--reads', type=int, default=2000, help='number of random single reads to time')
+    parser.add_argument('--dict-size', type=int, default=64*1024, help='size of the trained zstd dictionary, in bytes')
+    parser.add_argument('--save-dict', action='store_true', help='keep the trained zstd dictionary as the one the table compresses with')
+    args = parser.parse_args()
+    print(args)
+
+    # read the values of the table, whatever codec they are stored with now
+    fname, serializer = TABLES[args.table]
+    codec = table_codec(args.table, serializer)
+    conn = sqlite3.connect('file:%s?mode=ro' % (fname, ), uri=True)
+    query = 'SELECT key, value FROM "%s" ORDER BY rowid' % (args.table, ) + (' LIMIT %d' % (args.num, ) if args.num else '')
+    items = [(k, codec.decode(v)) for k, v in conn.execute(query)]
+    conn.close()
+    if not items:
+        raise SystemExit("the %s table is empty" % (args.table, ))
+    keys = [k for k, v in random.choices(items, k=args.reads)]
+    dumps = SERIALIZERS[serializer][0]
+    print("%d values of %s, %.2f MB serialized" % (len(items), args.table, sum(len(dumps(v)) for k, v in items) / 1e6))
+
+    compressions = ['none', 'zlib:1', 'zlib', 'zlib:9', 'lz4', 'lz4:9', 'zstd:1', 'zstd', 'zstd:19', 'zstd-dict:1', 'zstd-dict']
+    zdict = None
+    if 'zstd' in COMPRESSIONS:
+        samples = [dumps(v) for k, v in random.sample(items, min(len(items), 10000))]
+        zdict = train_zstd_dict(args.table, samples, dict_size=args.dict_size, save=args.save_dict)
+
+    print("%-12s %11s %11s %11s %13s %13s" % ('compression', 'size', 'read p50', 'read p99', 'scan', 'write'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for compression in compressions:
+            if compression.partition(':')[0] not in COMPRESSIONS:
+                continue
+            bench(compression, Codec(serializer, compression, args.table, zdict=zdict), items, keys, tmpdir)
+    if zdict is not None and args.save_dict:
+        print("saved zstd dictionary %d for %s" % (zdict.dict_id(), args.table))
@@ -0,0 +1,74 @@
+"""
+Benchmarks the parsing of arxiv api responses: our streaming parser against the
+feedparser path that we used before, on raw responses recorded with e.g.
+python arxiv_daemon.py --num 2000 --record data/responses
+Also reports how big the paper records are once they are stored.
+"""
+
+import os
+import sys
+import time
+import glob
+import zlib
+import pickle
+import argparse
+
+from aslite.arxiv import parse_response, parse_arxiv_url
+
+def feedparser_parse_response(response):
+    """ the previous implementation of parse_response, on top of feedparser """
+    import feedparser
+
+    def encode_feedparser_dict(d):
+        if isinstance(d, feedparser.FeedParserDict) or isinstance(d, dict):
+            return {k: encode_feedparser_dict(d[k]) for k in d.keys()}
+        elif isinstance(d, list):
+            return [encode_feedparser_dict(k) for k in d]
+        else:
+            return d
+
+    out = []
+    parse = feedparser.parse(response)
+    for e in parse.entries:
+        j = encode_feedparser_dict(e)
+        idv, rawid, version = parse_arxiv_url(j['id'])
+        j['_idv'] = idv
+        j['_id'] = rawid
+        j['_version'] = version
+        j['_time'] = time.mktime(j['updated_parsed'])
+        j['_time_str'] = time.strftime('%b %d %Y', j['updated_parsed'])
+        del j['summary_detail']
+        del j['title_detail']
+        out.append(j)
+    return out
+
+def bench(name, parse, responses, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        papers = [p for r in responses for p in parse(r)]
+        best = min(best, time.perf_counter() - t0)
+    mb = sum(len(r) for r in responses) / 1e6
+    stored = sum(len(zlib.compress(pickle.dumps(p, pickle.HIGHEST_PROTOCOL))) for p in papers) / len(papers)
+    print("%-10s %8.0f papers/s %7.1f MB/s   %6.0f bytes per stored paper" % (name, len(papers) / best, mb / best, stored))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks the parsing of recorded arxiv api responses')
+    parser.add_argument('dir', type=str, help='directory of recorded responses, see arxiv_daemon.py --record')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='take the best time of this many runs')
+    args = parser.parse_args()
+
+    responses = []
+    for fname in sorted(glob.glob(os.path.join(args.dir, '*.xml'))):
+        with open(fname, 'rb') as f:
+            responses.append(f.read())
+    if not responses:
+        sys.exit("no .xml responses in %s" % (args.dir, ))
+    print("%d responses, %.1f MB" % (len(responses), sum(len(r) for r in responses) / 1e6))
+
+    bench('streaming', parse_response, responses, args.repeat)
+    try:
+        bench('feedparser', feedparser_parse_response, responses, args.repeat)
+    except ImportError:
+        print("feedparser is not installed, skipping it")
@@ -1,14 +1,149 @@
 """
 Extracts tfidf features from all paper abstracts and saves them to disk.
+Optionally also a dense low-rank (lsa) projection of them, and the nearest neighbors of every paper.
 """
 
+import os
 import argparse
 from random import shuffle
+from multiprocessing import Pool
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
+from sklearn.pipeline import make_pipeline
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer, TfidfTransformer
 
-from aslite.db import get_papers_db, save_features
+from aslite.db import get_papers_db, get_metas_db, get_many, rowid_ranges, iter_rowid_range
+from aslite.db import save_features, load_features, save_search_index, SEARCH_DB_FILE
+
+# -----------------------------------------------------------------------------
+
+def knn_graph(x, k, max_block_elements=2**25):
+    """
+    computes the top k cosine similarity neighbors of every row of x, excluding
+    the row itself. the rows of x are already l2 normalized, so cosine similarity
+    is just x @ x.T, which we compute a block of rows at a time so that the dense
+    (block, n) similarity matrix stays within max_block_elements.
+    returns (n, k) arrays of neighbor row indices and their similarities, best first.
+    """
+    n = x.shape[0]
+    k = min(k, n - 1)
+    xt = x.T.tocsr()
+    block = max(1, max_block_elements // n)
+    knn_ix = np.zeros((n, k), dtype=np.int32)
+    knn_sim = np.zeros((n, k), dtype=np.float32)
+    for i0 in range(0, n, block):
+        i1 = min(n, i0 + block)
+        s = (x[i0:i1] @ xt).toarray()
+        s[np.arange(i1 - i0), np.arange(i0, i1)] = -np.inf # a paper is not its own neighbor
+        top = np.argpartition(-s, k - 1, axis=1)[:, :k]
+        top_sim = np.take_along_axis(s, top, axis=1)
+        order = np.argsort(-top_sim, axis=1)
+        knn_ix[i0:i1] = np.take_along_axis(top, order, axis=1)
+        knn_sim[i0:i1] = np.take_along_axis(top_sim, order, axis=1)
+    return knn_ix, knn_sim
+
+def lsa_project(x, components):
+    """ projects the rows of x onto the lsa components, and l2 normalizes them like the tfidf rows """
+    z = np.asarray(x @ components.T, dtype=np.float32)
+    z /= np.maximum(np.linalg.norm(z, axis=1, keepdims=True), 1e-12)
+    return z
+
+def lsa_fit(x, k):
+    """
+    fits a rank k latent semantic analysis of x with a randomized truncated svd.
+    returns the (n, k) dense float32 projection of every row and the (k, d)
+    components, which project any further rows the same way.
+    """
+    svd = TruncatedSVD(n_components=min(k, x.shape[1] - 1), algorithm='randomized', n_iter=5, random_state=0)
+    svd.fit(x)
+    components = svd.components_.astype(np.float32)
+    return lsa_project(x, components), components
+
+# -----------------------------------------------------------------------------
+# vectorizers
+
+# how the paper text is split into tokens, shared by the tfidf and the hashing vectorizers
+TOKEN_KWARGS = dict(input='content',
+                    encoding='utf-8', decode_error='replace', strip_accents='unicode',
+                    lowercase=True, analyzer='word', stop_words='english',
+                    token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
+                    ngram_range=(1, 2))
+TFIDF_KWARGS = dict(norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True)
+
+def make_tfidf(vocab=None, idf=None, **kwargs):
+    """ a tfidf vectorizer, optionally already fitted with the given vocab and idf """
+    v = TfidfVectorizer(vocabulary=vocab, **TOKEN_KWARGS, **TFIDF_KWARGS, **kwargs)
+    if idf is not None:
+        v.idf_ = idf
+    return v
+
+def make_hashing(hash_bits, idf=None):
+    """
+    a hashing vectorizer that emits raw counts, and so needs no fitting. pass the
+    idf to get a pipeline that goes all the way to the same tfidf as the above.
+    """
+    hv = HashingVectorizer(n_features=2**hash_bits, alternate_sign=False, norm=None, **TOKEN_KWARGS)
+    if idf is None:
+        return hv
+    t = TfidfTransformer(**TFIDF_KWARGS)
+    t.idf_ = idf
+    return make_pipeline(hv, t)
+
+# -----------------------------------------------------------------------------
+# corpus streaming, one chunk of papers at a time, possibly in a worker process
+
+def paper_text(d):
+    author_str = ' '.join([a['name'] for a in d['authors']])
+    return ' '.join([d['title'], d['summary'], author_str])
+
+def read_chunk(chunk):
+    """
+    reads one chunk of papers straight from sqlite, where a chunk is either a
+    (lo, hi) rowid range or a list of pids. returns their pids and texts.
+    """
+    pdb = get_papers_db(flag='r') # every process gets its own read-only connection
+    if isinstance(chunk, tuple):
+        items = iter_rowid_range(pdb, *chunk)
+    else:
+        items = get_many(pdb, chunk).items()
+    pids, texts = [], []
+    for pid, d in items:
+        pids.append(pid)
+        texts.append(paper_text(d))
+    return pids, texts
+
+_vectorizer = None # the (fitted) vectorizer of the worker process
+
+def _init_worker(v):
+    global _vectorizer
+    _vectorizer = v
+
+def transform_chunk(chunk):
+    """ reads one chunk of papers and returns their pids and (sparse) vectors """
+    pids, texts = read_chunk(chunk)
+    if not pids:
+        return pids, None
+    return pids, _vectorizer.transform(texts).astype(np.float32)
+
+def map_chunks(fn, chunks, workers, v=None):
+    """ yields fn(chunk) for all chunks in order, computed by a pool of workers """
+    if workers <= 1:
+        _init_worker(v)
+        yield from map(fn, chunks)
+        return
+    with Pool(workers, initializer=_init_worker, initargs=(v, )) as pool:
+        yield from pool.imap(fn, chunks)
+
+def transform_chunks(chunks, workers, v):
+    """ transforms all chunks in parallel and stacks the results, in order """
+    pids, xs = [], []
+    for chunk_pids, x in map_chunks(transform_chunk, chunks, workers, v):
+        if chunk_pids:
+            pids.extend(chunk_pids)
+            xs.append(x)
+    return pids, xs
 
 # -----------------------------------------------------------------------------
 
@@ -19,49 +154,142 @@ if __name__ == '__main__':
     parser.add_argument('--min_df', type=int, default=5, help='min df')
     parser.add_argument('--max_df', type=float, default=0.1, help='max df')
     parser.add_argument('--max_docs', type=int, default=-1, help='maximum number of documents to use when training tfidf, or -1 to disable')
+    parser.add_argument('--hash_bits', type=int, default=0, help='hash the tokens into 2**hash_bits columns instead of fitting a vocabulary of --num words, or 0 to disable')
+    parser.add_argument('--knn', type=int, default=None, help='number of nearest neighbors to precompute per paper for rank=pid, or 0 to disable. in incremental mode defaults to that of the previous features')
+    parser.add_argument('--lsa', type=int, default=None, help='number of dimensions of a dense low-rank (lsa) projection of the tfidf to also compute, or 0 to disable. in incremental mode defaults to that of the previous features')
+    parser.add_argument('-i', '--incremental', action='store_true', help='only transform the papers added or updated since the last run, reusing its vocabulary and idf')
+    parser.add_argument('--refit_frac', type=float, default=0.1, help='in incremental mode, refit from scratch once more than this fraction of the papers is new or updated since the last full fit')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes that read and transform the papers')
+    parser.add_argument('--chunk_size', type=int, default=2000, help='number of papers per chunk handed to a worker')
     args = parser.parse_args()
     print(args)
 
-    v = TfidfVectorizer(input='content',
-                        encoding='utf-8', decode_error='replace', strip_accents='unicode',
-                        lowercase=True, analyzer='word', stop_words='english',
-                        token_pattern=r'(?u)\b[a-zA-Z_][a-zA-Z0-9_]+\b',
-                        ngram_range=(1, 2), max_features=args.num,
-                        norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
-                        max_df=args.max_df, min_df=args.min_df)
-
     pdb = get_papers_db(flag='r')
+    mdb = get_metas_db(flag='r')
+    mtimes = {k: m['_time'] for k, m in mdb.items()}
+    tmax = max(mtimes.values(), default=0)
+
+    def key_chunks(keys):
+        return [keys[i:i+args.chunk_size] for i in range(0, len(keys), args.chunk_size)]
 
-    def make_corpus(training: bool):
-        assert isinstance(training, bool)
+    # see if the previous features can be updated in place, or we need a full refit
+    prev = None
+    if args.incremental:
+        try:
+            prev = load_features()
+        except FileNotFoundError:
+            print("no previous features found, doing a full refit")
+        # keep computing whatever the previous run did unless told otherwise, even if we refit below
+        if prev is not None and args.knn is None:
+            args.knn = prev.get('knn', prev['knn_ix'].shape[1] if 'knn_ix' in prev else 0)
+        if prev is not None and args.lsa is None:
+            args.lsa = prev.get('lsa_dims', len(prev['lsa_components']) if 'lsa_components' in prev else 0)
+        if prev is not None and 'tmax' not in prev:
+            print("previous features do not record their version, doing a full refit")
+            prev = None
+        if prev is not None and prev.get('hash_bits', 0) != args.hash_bits:
+            print("previous features used a different vectorizer, doing a full refit")
+            prev = None
+    if prev is not None:
+        # the papers updated since, and the ones that have no row at all, e.g. older papers
+        # that came in through a backfill (arxiv_daemon.py --start) or import_snapshot.py
+        known = set(prev['pids'])
+        stale = [k for k, t in mtimes.items() if t > prev['tmax'] or k not in known]
+        nstale = prev['nstale'] + len(stale)
+        if nstale > args.refit_frac * prev['nfit']:
+            print("%d of %d papers are new or updated since the last full fit, doing a full refit" % (nstale, prev['nfit']))
+            prev = None
 
-        # determine which papers we will use to build tfidf
-        if training and args.max_docs > 0 and args.max_docs < len(pdb):
-            # crop to a random subset of papers
-            keys = list(pdb.keys())
-            shuffle(keys)
-            keys = keys[:args.max_docs]
+    args.knn = args.knn or 0
+    args.lsa = args.lsa or 0
+
+    if prev is None:
+        chunks = rowid_ranges(pdb, args.chunk_size)
+        if args.hash_bits > 0:
+            # no shared vocabulary, so a single parallel pass over the papers does it
+            print("hashing token counts...")
+            pids, xs = transform_chunks(chunks, args.workers, make_hashing(args.hash_bits))
+            counts = sp.vstack(xs, format='csr')
+
+            # fit the idf on the counts, zeroing it out for the tokens outside of the df limits
+            t = TfidfTransformer(**TFIDF_KWARGS).fit(counts)
+            df = np.bincount(counts.indices, minlength=counts.shape[1])
+            idf = t.idf_.copy()
+            idf[(df < args.min_df) | (df > args.max_df * counts.shape[0])] = 0
+            t.idf_ = idf
+            x = t.transform(counts).astype(np.float32)
+            x.eliminate_zeros()
+            vocab = {}
         else:
-            keys = pdb.keys()
+            v = make_tfidf(max_features=args.num, max_df=args.max_df, min_df=args.min_df)
+
+            # determine which papers we will use to build tfidf
+            if args.max_docs > 0 and args.max_docs < len(pdb):
+                # crop to a random subset of papers
+                keys = list(pdb.keys())
+                shuffle(keys)
+                training = key_chunks(keys[:args.max_docs])
+            else:
+                training = chunks
 
-        # yield the abstracts of the papers
-        for p in keys:
-            d = pdb[p]
-            author_str = ' '.join([a['name'] for a in d['authors']])
-            yield ' '.join([d['title'], d['summary'], author_str])
+            # the papers are read in parallel, but fitting the vocabulary is one pass
+            print("training tfidf vectors...")
+            v.fit(text for _, texts in map_chunks(read_chunk, training, args.workers) for text in texts)
 
-    print("training tfidf vectors...")
-    v.fit(make_corpus(training=True))
+            print("running inference...")
+            pids, xs = transform_chunks(chunks, args.workers, v)
+            x = sp.vstack(xs, format='csr')
+            vocab, idf = v.vocabulary_, v.idf_
+        nfit, nstale = len(pids), 0
+    else:
+        # reuse the fitted vocabulary and idf, so the old rows stay valid as they are
+        vocab, idf = prev['vocab'], prev['idf']
+        v = make_hashing(args.hash_bits, idf) if args.hash_bits > 0 else make_tfidf(vocab, idf)
 
-    print("running inference...")
-    x = v.transform(make_corpus(training=False)).astype(np.float32)
+        print("running inference on %d new or updated papers..." % (len(stale), ))
+        stale, xs = transform_chunks(key_chunks(stale), args.workers, v)
+        xs = sp.vstack(xs, format='csr') if xs else sp.csr_matrix((0, prev['x'].shape[1]), dtype=np.float32)
+
+        # new papers get appended, updated ones point at their fresh row instead of the old one
+        n = len(prev['pids'])
+        pids = prev['pids'] + [p for p in stale if p not in known]
+        ptoi = {p: i for i, p in enumerate(pids)}
+        rows = np.arange(len(pids))
+        for j, p in enumerate(stale):
+            rows[ptoi[p]] = n + j
+        x = sp.vstack([prev['x'], xs], format='csr')[rows]
+        nfit = prev['nfit']
     print(x.shape)
 
     print("saving to features to disk...")
     features = {
-        'pids': list(pdb.keys()),
+        'pids': pids,
         'x': x,
-        'vocab': v.vocabulary_,
-        'idf': v._tfidf.idf_,
+        'vocab': vocab, # empty for hashed features
+        'idf': idf,
+        'hash_bits': args.hash_bits,
+        'tmax': tmax, # the metas _time of the newest paper covered by these features
+        'nfit': nfit, # number of papers seen by the last full fit
+        'nstale': nstale, # number of papers transformed incrementally since then
+        'knn': args.knn, # number of precomputed neighbors per paper, or 0 for none
+        'lsa_dims': args.lsa, # requested dimensions of the lsa projection, or 0 for none
     }
+    if args.knn > 0:
+        print("computing the %d nearest neighbors of every paper..." % (args.knn, ))
+        features['knn_ix'], features['knn_sim'] = knn_graph(x, args.knn)
+    if args.lsa > 0:
+        if prev is not None and 'lsa_components' in prev and len(prev['lsa_components']) == min(args.lsa, x.shape[1] - 1):
+            # same as the tfidf, only the new or updated rows need projecting
+            components = prev['lsa_components']
+            lsa = np.vstack([prev['lsa'], lsa_project(xs, components)])[rows]
+        else:
+            print("computing a %d dimensional lsa projection..." % (args.lsa, ))
+            lsa, components = lsa_fit(x, args.lsa)
+        features['lsa'], features['lsa_components'] = lsa, components
     save_features(features)
+
+    # the daemon keeps the search index up to date, so only rebuild it from scratch on a full
+    # refit, or if there is no index yet (the daemon never creates one)
+    if prev is None or not os.path.isfile(SEARCH_DB_FILE):
+        print("building the search index...")
+        save_search_index(pdb.values())
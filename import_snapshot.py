@@ -0,0 +1,97 @@
+"""
+Seeds the database from a local copy of the arxiv metadata snapshot, i.e. the json
+lines file with one record per paper of all of arxiv (arxiv-metadata-oai-snapshot.json,
+e.g. from kaggle), instead of paging through the whole archive with the api.
+The file is streamed line by line and the papers in our categories are stored in
+large batches, one transaction each, so memory stays bounded however big it is.
+After every batch the byte offset is saved, and --resume continues from there.
+Like arxiv_daemon.py it adds the papers to the search index if there is one,
+and if there is none the next compute.py run builds it over all the papers.
+Afterwards run compute.py to compute the features of the new papers.
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+
+from aslite.arxiv import parse_snapshot_record, Q_CATEGORIES
+from aslite.db import get_metas_db, get_search_index, upsert_papers, save_time_index, SEARCH_DB_FILE
+from aslite.db import save_cursor, load_cursor, clear_cursor
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO, format='%(name)s %(levelname)s %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    parser = argparse.ArgumentParser(description='Imports papers from an arxiv metadata snapshot')
+    parser.add_argument('snapshot', type=str, help='path to the json lines snapshot file')
+    parser.add_argument('-b', '--batch-size', type=int, default=10000, help='papers stored per transaction')
+    parser.add_argument('-o', '--offset', type=int, default=0, help='byte offset in the file to start reading at')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted import of this file from its saved offset, instead of at --offset')
+    args = parser.parse_args()
+    print(args)
+
+    path = os.path.abspath(args.snapshot)
+    size = os.path.getsize(path)
+    offset = args.offset
+    if args.resume:
+        cursor = load_cursor('import')
+        if cursor is not None and cursor['path'] == path:
+            offset = cursor['offset']
+            logging.info('resuming the previous import at byte %d of %d' % (offset, size))
+        else:
+            logging.info('no previous import of this file to resume, starting at byte %d' % (offset, ))
+
+    # a record can only be in one of our categories if the name of one appears on its line,
+    # which rules out most lines of the snapshot without parsing them
+    categories = set(Q_CATEGORIES)
+    needles = [c.encode('utf-8') for c in Q_CATEGORIES]
+
+    # keep an existing search index up to date, same as arxiv_daemon.py does
+    sidx = get_search_index(flag='c') if os.path.isfile(SEARCH_DB_FILE) else None
+
+    nlines, nkept, nnew, nreplace = 0, 0, 0, 0
+    t0 = time.time()
+    batch = []
+
+    def store():
+        global nnew, nreplace
+        new, replaced = upsert_papers(batch)
+        if sidx is not None:
+            sidx.add(new + replaced)
+            sidx.commit()
+        nnew += len(new)
+        nreplace += len(replaced)
+        batch.clear()
+        save_cursor('import', {'path': path, 'offset': offset})
+        logging.info("%.1f%% of the file: %d lines, %d in our categories, %d new, %d replaced, %.0f lines/s" %
+                     (100 * offset / max(size, 1), nlines, nkept, nnew, nreplace, nlines / (time.time() - t0)))
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            nlines += 1
+            if not any(n in line for n in needles):
+                continue
+            try:
+                r = json.loads(line)
+            except ValueError:
+                logging.warning("skipping a line that is not valid json, ending at byte %d" % (offset, ))
+                continue
+            if not categories.intersection(r['categories'].split()):
+                continue
+            batch.append(parse_snapshot_record(r))
+            nkept += 1
+            if len(batch) >= args.batch_size:
+                store()
+    store()
+    clear_cursor('import') # this import is complete
+    if sidx is not None:
+        sidx.close()
+
+    # refresh the time-sorted index of all papers that serve.py ranks and filters with
+    logging.info("rebuilding the time index...")
+    save_time_index(get_metas_db(flag='r').items())
+    logging.info("done. %d new papers, %d replaced by newer versions, in %.0fs" % (nnew, nreplace, time.time() - t0))
@@ -0,0 +1,86 @@
+"""
+Rewrites the paper records in papers.db that are still whole feedparser dicts
+into the compact schema (see PAPER_SCHEMAS in aslite/db.py), and the ones stored
+with another compression than TABLE_COMPRESSION['papers'], and writes the cards
+of the papers stored before there was a cards table, so the list views never
+fall back to decoding the full records. All of it in place and in batches of
+rows, each batch its own transaction, so the server and the daemons can keep
+running, memory stays flat, and an interrupted run just continues where it
+stopped when run again. Reports the size and decode time saved.
+"""
+
+import os
+import time
+import pickle
+import sqlite3
+import argparse
+
+from aslite.db import PAPERS_DB_FILE, BUSY_TIMEOUT, MAKE_TABLE, get_papers_db, rowid_ranges, table_codec, decompress_value
+from aslite.db import paper_to_card
+
+def file_size(fname):
+    return sum(os.path.getsize(f) for f in [fname, fname + '-wal'] if os.path.isfile(f))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Migrates papers.db to the compact paper records')
+    parser.add_argument('-b', '--batch-size', type=int, default=2000, help='rows rewritten per transaction')
+    parser.add_argument('--vacuum', action='store_true', help='vacuum the database file afterwards, to give the freed space back to the filesystem')
+    args = parser.parse_args()
+    print(args)
+
+    codec = table_codec('papers', 'paper')
+    card_codec = table_codec('cards', 'card')
+    conn = sqlite3.connect(PAPERS_DB_FILE, isolation_level=None, timeout=BUSY_TIMEOUT)
+    conn.execute(MAKE_TABLE % 'cards')
+    size_before = file_size(PAPERS_DB_FILE)
+
+    nrows, nmigrated, ncards = 0, 0, 0
+    bytes_old, bytes_new = 0, 0 # of the migrated rows only
+    t_old, t_new = 0.0, 0.0 # time to decode them, before and after
+    t0 = time.time()
+    ranges = rowid_ranges(get_papers_db(flag='r'), args.batch_size)
+    for lo, hi in ranges:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute('SELECT rowid, value FROM papers WHERE rowid BETWEEN ? AND ?', (lo, hi)).fetchall()
+        updates = []
+        for rowid, value in rows:
+            if value[0] == codec.cid and not isinstance(pickle.loads(decompress_value(value)), dict):
+                continue # already compact, and compressed the way it should be
+            t = time.perf_counter()
+            p = codec.decode(value)
+            t_old += time.perf_counter() - t
+            new = codec.encode(p)
+            t = time.perf_counter()
+            codec.decode(new)
+            t_new += time.perf_counter() - t
+            bytes_old += len(value)
+            bytes_new += len(new)
+            updates.append((new, rowid))
+        # update in place, the rowids (the order compute.py reads the papers in) stay the same
+        conn.executemany('UPDATE papers SET value = ? WHERE rowid = ?', updates)
+        # and write the cards of the papers in this batch that don't have one
+        missing = conn.execute('SELECT key, value FROM papers WHERE rowid BETWEEN ? AND ? '
+                               'AND NOT EXISTS (SELECT 1 FROM cards WHERE cards.key = papers.key)', (lo, hi)).fetchall()
+        conn.executemany('INSERT INTO cards (key, value) VALUES (?, ?)',
+                         [(k, card_codec.encode(paper_to_card(codec.decode(v)))) for k, v in missing])
+        conn.execute('COMMIT')
+        nrows += len(rows)
+        nmigrated += len(updates)
+        ncards += len(missing)
+        print("%d rows, migrated %d, added %d cards" % (nrows, nmigrated, ncards), end='\r')
+    print()
+
+    if args.vacuum:
+        print("vacuuming...")
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)') # the vacuumed pages go through the wal too
+    conn.close()
+
+    print("migrated %d of %d papers and added %d missing cards in %.1fs" % (nmigrated, nrows, ncards, time.time() - t0))
+    if nmigrated:
+        print("stored size of the migrated records: %.1f MB -> %.1f MB (%.0f%% smaller)" %
+              (bytes_old / 1e6, bytes_new / 1e6, 100 * (1 - bytes_new / bytes_old)))
+        print("time to decode them: %.2fs -> %.2fs (%.1fx faster)" % (t_old, t_new, t_old / max(t_new, 1e-9)))
+    print("papers.db on disk: %.1f MB -> %.1f MB%s" % (size_before / 1e6, file_size(PAPERS_DB_FILE) / 1e6,
+          '' if args.vacuum else ', run with --vacuum to release the freed pages'))
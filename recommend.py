@@ -0,0 +1,70 @@
+"""
+Precomputes the ranked recommendations of all recently active users, using the
+same svms as the emails, and stores them so that serve.py can show them
+instantly under rank=recommended instead of training an svm on the request.
+I run this right after compute.py, whenever the features were updated.
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from aslite.db import load_features
+from aslite.db import get_tags_db
+from aslite.db import get_last_active_db
+from aslite.db import get_recommendations_db, tags_fingerprint, REC_TIME_DELTA
+from send_emails import recent_candidates, calculate_recommendation
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Precomputes recommendations for the active users')
+    parser.add_argument('-a', '--active-days', type=float, default=14, help='only users that were active in the last this many days')
+    parser.add_argument('-t', '--time-delta', type=int, default=REC_TIME_DELTA, help='how recent papers to recommend, in days')
+    parser.add_argument('-n', '--num', type=int, default=500, help='number of recommendations to store per user')
+    parser.add_argument('-f', '--features', type=str, default='tfidf', choices=['tfidf', 'lsa'], help='train the svms on the sparse tfidf features or on their dense low-rank lsa projection (needs compute.py --lsa)')
+    args = parser.parse_args()
+    print(args)
+
+    tnow = time.time()
+
+    # the users that were active recently and have tags to learn from
+    with get_last_active_db(flag='r') as ladb:
+        active = {u for u, t in ladb.items() if tnow - t < args.active_days*60*60*24}
+    with get_tags_db(flag='r') as tags_db:
+        all_tags = {u: tags for u, tags in tags_db.items() if u in active and any(tags.values())}
+    print("%d active users, %d of them have tagged papers" % (len(active), len(all_tags)))
+
+    # read the features, same as send_emails.py
+    features = load_features()
+    if args.features == 'lsa' and 'lsa' not in features:
+        print("no lsa features were computed, run compute.py with --lsa. falling back to tfidf")
+        args.features = 'tfidf'
+    x = (features['lsa'] if args.features == 'lsa' else features['x']).astype(np.float64)
+    pids = features['pids']
+    ptoi = {p: i for i, p in enumerate(pids)}
+    candidates = recent_candidates(ptoi, tnow - args.time_delta*60*60*24)
+    print("%d papers from the last %d days to recommend from" % (len(candidates), args.time_delta))
+
+    recs = {}
+    for user, tags in all_tags.items():
+        rec_pids, tag_names, scores = calculate_recommendation(tags, candidates, x, pids, ptoi)
+        # merge the tags with a MAX like the emails do, and keep only the top of the ranking
+        max_score = scores.max(axis=1) if len(rec_pids) else np.zeros(0)
+        top = np.argsort(-max_score)[:args.num]
+        recs[user] = {
+            'pids': [rec_pids[i] for i in top],
+            'scores': max_score[top].astype(np.float32),
+            'time': tnow, # when these were computed
+            'features_version': features['version'], # from which features
+            'tags': tags_fingerprint(tags), # and from which tags of the user
+            'time_delta': args.time_delta,
+        }
+
+    # write them all out in a single transaction
+    with get_recommendations_db(flag='c', autocommit=False) as rdb:
+        rdb.update(recs)
+        rdb.commit()
+    print("stored the recommendations of %d users" % (len(recs), ))
@@ -0,0 +1,62 @@
+"""
+A stand-in for the arxiv api that replays the responses arxiv_daemon.py saved with
+--record DIR, so that a run can be repeated offline and without pestering arxiv, e.g.
+
+python replay_arxiv.py DIR --port 8000
+python arxiv_daemon.py --api-url "http://localhost:8000/api/query?"
+
+Every request is answered with the recorded start_<k>.xml of its start= parameter,
+whatever the rest of the query, and with an empty feed (like the api gives past the
+last result) if there is no recording for it.
+"""
+
+import os
+import logging
+import argparse
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMPTY_FEED = b'<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom"></feed>\n'
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    record_dir = '.' # set to the directory of the recordings before serving
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            k = int(query['start'][0])
+        except (KeyError, ValueError):
+            self.send_error(400, 'expected an integer start= parameter')
+            return
+        path = os.path.join(self.record_dir, 'start_%d.xml' % (k, ))
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                body = f.read()
+        else:
+            logging.warning("no recording for start=%d, replying with an empty feed" % (k, ))
+            body = EMPTY_FEED
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/atom+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO, format='%(name)s %(levelname)s %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    parser = argparse.ArgumentParser(description='Replays recorded arxiv api responses')
+    parser.add_argument('record_dir', type=str, help='directory with the start_<k>.xml responses saved by arxiv_daemon.py --record')
+    parser.add_argument('--host', type=str, default='localhost', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='port to listen on')
+    args = parser.parse_args()
+    print(args)
+
+    ReplayHandler.record_dir = args.record_dir
+    nrec = sum(1 for f in os.listdir(args.record_dir) if f.startswith('start_') and f.endswith('.xml'))
+    logging.info("replaying %d recorded responses at http://%s:%d/api/query?" % (nrec, args.host, args.port))
+    ThreadingHTTPServer((args.host, args.port), ReplayHandler).serve_forever()
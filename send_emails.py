@@ -7,24 +7,31 @@ the recommendations may become more complex in the future, so this is ok for now
 
 You'll notice that the file sendgrid_api_key.txt is not in the repo, you'd have
 to manually register with sendgrid yourself, get an API key and put it in the file.
+Alternatively --transport smtp or --transport file deliver to an smtp server or
+write the emails to disk, e.g. to test the whole thing offline.
 """
 
 import os
 import time
 import random
 import argparse
+import functools
+import threading
+import multiprocessing
 
 import numpy as np
 from sklearn import svm
-
-import sendgrid
-from sendgrid.helpers.mail import Email, To, Content, Mail
+from sklearn.multiclass import OneVsRestClassifier
 
 from aslite.db import load_features
 from aslite.db import get_tags_db
 from aslite.db import get_metas_db
+from aslite.db import load_time_index, TimeIndex, TIME_INDEX_FILE
 from aslite.db import get_papers_db
+from aslite.db import get_cards_db, fetch_cards
 from aslite.db import get_email_db
+from aslite.db import get_email_checkpoint
+from aslite.mail import Mailer, NullTransport, SendGridTransport, SMTPTransport, FileTransport
 
 # -----------------------------------------------------------------------------
 # the html template for the email
@@ -79,80 +86,77 @@ To stop these emails remove your email in your <a href="https://arxiv-sanity-lit
 
 # -----------------------------------------------------------------------------
 
+def recent_candidates(ptoi, tmin):
+    """ returns the sorted feature rows of the papers with _time after tmin, the only ones we recommend """
+    tidx = load_time_index() if os.path.isfile(TIME_INDEX_FILE) else None
+    if tidx is None:
+        with get_metas_db(flag='r') as mdb:
+            tidx = TimeIndex.from_metas(mdb.items())
+    recent = tidx.pids[tidx.since(tmin):]
+    return np.array(sorted(ptoi[pid] for pid in recent if pid in ptoi), dtype=np.int64)
+
 def calculate_recommendation(
     tags,
-    time_delta = 3, # how recent papers are we recommending? in days
+    candidates, # sorted feature rows of the recent papers, the only ones we recommend
+    x, # (n, d) features of all papers, in float64
+    pids, # row index -> pid
+    ptoi, # pid -> row index
     ):
-
-    # a bit of preprocessing
-    x, pids = features['x'], features['pids']
+    """
+    trains one svm per (non-empty) tag, all together as a single one-vs-rest problem,
+    and scores the candidate papers we don't have yet against all of them at once.
+    returns the candidate pids, the tag names, and the (len(pids), len(tags)) matrix of
+    scores of every candidate paper under every tag.
+    """
     n, d = x.shape
-    ptoi, itop = {}, {}
-    for i, p in enumerate(pids):
-        ptoi[p] = i
-        itop[i] = p
-
-    # loop over all the tags
-    all_pids, all_scores = {}, {}
-    for tag, pids in tags.items():
-
-        if len(pids) == 0:
-            continue
-
-        # construct the positive set for this tag
-        y = np.zeros(n, dtype=np.float32)
-        for pid in pids:
-            y[ptoi[pid]] = 1.0
-
-        # classify
-        clf = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=0.01)
-        clf.fit(x, y)
-        s = clf.decision_function(x)
-        sortix = np.argsort(-s)
-        pids = [itop[ix] for ix in sortix]
-        scores = [100*float(s[ix]) for ix in sortix]
-
-        # filter by time to only recent papers
-        deltat = time_delta*60*60*24 # allowed time delta in seconds
-        keep = [i for i,pid in enumerate(pids) if (tnow - metas[pid]['_time']) < deltat]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
-
-        # finally exclude the papers we already have tagged
-        have = set().union(*tags.values())
-        keep = [i for i,pid in enumerate(pids) if pid not in have]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
-
-        # store results
-        all_pids[tag] = pids
-        all_scores[tag] = scores
-
 
-    return all_pids, all_scores
+    # papers that have no feature row yet (compute.py didn't see them) can't be trained on
+    tags = {tag: [pid for pid in tpids if pid in ptoi] for tag, tpids in tags.items()}
+
+    # construct the positive sets of all tags, one column per tag
+    tag_names = [tag for tag, tpids in tags.items() if len(tpids) > 0]
+    if not tag_names:
+        return [], tag_names, np.zeros((0, 0))
+    y = np.zeros((n, len(tag_names)), dtype=np.int8)
+    for j, tag in enumerate(tag_names):
+        for pid in tags[tag]:
+            y[ptoi[pid], j] = 1
+
+    # classify, all tags at once
+    base = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=0.01)
+    clf = OneVsRestClassifier(base).fit(x, y)
+    w = np.stack([e.coef_[0] for e in clf.estimators_], axis=1) # (d, tags)
+    b = np.array([e.intercept_[0] for e in clf.estimators_]) # (tags, )
+
+    # exclude the papers we already have tagged from the candidates
+    have = np.zeros(n, dtype=bool)
+    have[[ptoi[pid] for pid in set().union(*tags.values())]] = True
+    keep = candidates[~have[candidates]]
+
+    # score the remaining papers under all tags with a single product
+    scores = 100 * (x[keep] @ w + b)
+    return [pids[i] for i in keep], tag_names, scores
 
 # -----------------------------------------------------------------------------
 
-def render_recommendations(user, tags, tag_pids, tag_scores):
+def render_recommendations(user, tags, pids, tag_names, scores):
     # render the paper recommendations into the html template
 
-    # first we are going to merge all of the papers / scores together using a MAX
-    max_score = {}
-    max_source_tag = {}
-    for tag in tag_pids:
-        for pid, score in zip(tag_pids[tag], tag_scores[tag]):
-            max_score[pid] = max(max_score.get(pid, -99999), score) # lol
-            if max_score[pid] == score:
-                max_source_tag[pid] = tag
+    # first we are going to merge all of the papers / scores together using a MAX over the tags
+    max_score = scores.max(axis=1)
+    max_source_tag = scores.argmax(axis=1)
 
-    # now we have a dict of pid -> max score. sort by score
-    max_score_list = sorted(max_score.items(), key=lambda x: x[1], reverse=True)
-    pids, scores = zip(*max_score_list)
+    # sort by the max score
+    order = np.argsort(-max_score)
+    pids, scores, source_tags = [pids[i] for i in order], max_score[order], max_source_tag[order]
 
     # now render the html for each individual recommendation
     parts = []
     n = min(len(scores), args.num_recommendations)
-    for score, pid in zip(scores[:n], pids[:n]):
-        p = pdb[pid]
-        authors = ', '.join(a['name'] for a in p['authors'])
+    cards = fetch_cards(cdb, pids[:n], pdb)
+    for score, pid, source_tag in zip(scores[:n], pids[:n], source_tags[:n]):
+        p = cards[pid]
+        authors = p['authors']
         # crop the abstract
         summary = p['summary']
         summary = summary[:min(500, len(summary))]
@@ -170,7 +174,7 @@ def render_recommendations(user, tags, tag_pids, tag_scores):
 <div class="u">%s</div>
 </td>
 </tr>
-""" % (score, url, p['title'], max_source_tag[pid], authors, summary)
+""" % (score, url, p['title'], tag_names[source_tag], authors, summary)
         )
 
     # render the final html
@@ -196,27 +200,50 @@ def render_recommendations(user, tags, tag_pids, tag_scores):
     return out
 
 # -----------------------------------------------------------------------------
-# send the actual html via sendgrid
+# the work for a single user, in this process or in a forked worker
 
-def send_email(to, html):
+def _init_worker():
+    # the workers inherit the features and the candidates from the parent copy-on-write,
+    # but they open their own database handles instead of sharing the parent's connections
+    global pdb, cdb
+    pdb = get_papers_db(flag='r')
+    cdb = get_cards_db(flag='r')
 
-    # init the api
-    assert os.path.isfile('sendgrid_api_key.txt')
-    api_key = open('sendgrid_api_key.txt', 'r').read().strip()
-    sg = sendgrid.SendGridAPIClient(api_key=api_key)
+def recommend_user(user):
+    """ computes and renders the recommendations of one user, returns (user, html), html None if there are none """
+    tags = all_tags[user]
 
-    # construct the email
-    from_email = Email("admin@arxiv-sanity-lite.com")
-    to_email = To(to)
-    subject = tnow_str + " Arxiv Sanity Lite recommendations"
-    content = Content("text/html", html)
-    mail = Mail(from_email, to_email, subject, content)
+    # insert a fake entry in tags for the special "all" tag, which is the union of all papers
+    # tags['all'] = set().union(*tags.values())
+
+    # calculate the recommendations
+    rec_pids, tag_names, scores = calculate_recommendation(tags, candidates, x, pids, ptoi)
+    if len(rec_pids) == 0:
+        print("skipping user %s, no recommendations were produced" % (user, ))
+        return user, None
+
+    # render the html
+    print("rendering top %d recommendations into a report for %s..." % (args.num_recommendations, user))
+    html = render_recommendations(user, tags, rec_pids, tag_names, scores)
+    return user, html
 
-    # hope for the best :)
-    if not args.dry_run:
-        response = sg.client.mail.send.post(request_body=mail.get())
-        print(response.status_code)
-        pass
+# -----------------------------------------------------------------------------
+# the transport that sends the actual html
+
+def make_transport():
+    if args.dry_run:
+        return NullTransport()
+    if args.transport == 'sendgrid':
+        # init the api
+        assert os.path.isfile('sendgrid_api_key.txt')
+        api_key = open('sendgrid_api_key.txt', 'r').read().strip()
+        return SendGridTransport(api_key)
+    if args.transport == 'smtp':
+        host, _, port = args.smtp.partition(':')
+        return SMTPTransport(host, int(port or 25))
+    if args.transport == 'file':
+        return FileTransport(args.outbox)
+    raise ValueError("transport %s is not a thing" % (args.transport, ))
 
 # -----------------------------------------------------------------------------
 
@@ -228,6 +255,15 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--dry-run', type=int, default=0, help='if set to 1 do not actually send the emails')
     parser.add_argument('-u', '--user', type=str, default='', help='restrict recommendations only to a single given user (used for debugging)')
     parser.add_argument('-m', '--min-papers', type=int, default=1, help='user must have at least this many papers for us to send recommendations')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of forked processes that compute the recommendations of different users in parallel')
+    parser.add_argument('-r', '--run-id', type=str, default='', help='id of the run to resume, by default the date. users already done in the run are skipped')
+    parser.add_argument('--transport', type=str, default='sendgrid', choices=['sendgrid', 'smtp', 'file'], help='how to deliver the emails')
+    parser.add_argument('--smtp', type=str, default='localhost:1025', help='host:port of the smtp server, for --transport smtp')
+    parser.add_argument('--outbox', type=str, default='outbox', help='directory the emails are written to, for --transport file')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='number of emails in flight at once')
+    parser.add_argument('--rate', type=float, default=10, help='maximum number of emails sent per second, or 0 for no limit')
+    parser.add_argument('--retries', type=int, default=3, help='number of times a temporarily failed send is retried, with exponential backoff')
+    parser.add_argument('-f', '--features', type=str, default='tfidf', choices=['tfidf', 'lsa'], help='train the svms on the sparse tfidf features or on their dense low-rank lsa projection (needs compute.py --lsa)')
     args = parser.parse_args()
     print(args)
 
@@ -235,26 +271,38 @@ if __name__ == "__main__":
     tnow_str = time.strftime('%b %d', time.localtime(tnow)) # e.g. "Nov 27"
 
     # read entire db simply into RAM
-    with get_tags_db() as tags_db:
-        tags = {k:v for k,v in tags_db.items()}
-
-    # read entire db simply into RAM
-    with get_metas_db() as mdb:
-        metas = {k:v for k,v in mdb.items()}
+    with get_tags_db(flag='r') as tags_db:
+        all_tags = {k:v for k,v in tags_db.items()}
 
     # read entire db simply into RAM
-    with get_email_db() as edb:
+    with get_email_db(flag='r') as edb:
         emails = {k:v for k,v in edb.items()}
 
     # read tfidf features into RAM
     features = load_features()
+    if args.features == 'lsa' and 'lsa' not in features:
+        print("no lsa features were computed, run compute.py with --lsa. falling back to tfidf")
+        args.features = 'tfidf'
+    # liblinear wants float64, so we convert once here instead of once per user
+    x = (features['lsa'] if args.features == 'lsa' else features['x']).astype(np.float64)
+    pids = features['pids']
+    ptoi = {p: i for i, p in enumerate(pids)}
+
+    # we only ever recommend the papers of the last time_delta days, find their feature rows once
+    candidates = recent_candidates(ptoi, tnow - args.time_delta*60*60*24)
+    print("%d papers from the last %d days to recommend from" % (len(candidates), args.time_delta))
 
     # keep the papers as only a handle, since this can be larger
-    pdb = get_papers_db()
+    pdb = get_papers_db(flag='r')
+    cdb = get_cards_db(flag='r')
 
-    # iterate all users, create recommendations, send emails
-    num_sent = 0
-    for user, tags in tags.items():
+    # the checkpoint of this run, by default one run per day. dry runs only keep one if asked to
+    run_id = args.run_id or time.strftime('%Y-%m-%d', time.localtime(tnow))
+    checkpoint = get_email_checkpoint(run_id) if args.run_id or not args.dry_run else None
+
+    # decide which users get an email
+    users = []
+    for user, tags in all_tags.items():
 
         # verify that we have an email for this user
         email = emails.get(user, None)
@@ -264,6 +312,9 @@ if __name__ == "__main__":
         if args.user and user != args.user:
             print("skipping user %s, not %s" % (user, args.user))
             continue
+        if checkpoint is not None and user in checkpoint:
+            print("skipping user %s, already %s in run %s" % (user, checkpoint.done[user], run_id))
+            continue
 
         # verify that we have at least one positive example...
         num_papers_tagged = len(set().union(*tags.values()))
@@ -271,31 +322,57 @@ if __name__ == "__main__":
             print("skipping user %s, only has %d papers tagged" % (user, num_papers_tagged))
             continue
 
-        # insert a fake entry in tags for the special "all" tag, which is the union of all papers
-        # tags['all'] = set().union(*tags.values())
+        users.append(user)
+
+    # create the recommendations, in a pool of forked workers if asked to, and send them as they come in
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.get_context('fork').Pool(args.workers, initializer=_init_worker)
+        results = pool.imap_unordered(recommend_user, users)
+    else:
+        results = map(recommend_user, users)
 
-        # calculate the recommendations
-        pids, scores = calculate_recommendation(tags, time_delta=args.time_delta)
-        if all(len(lst) == 0 for tag, lst in pids.items()):
-            print("skipping user %s, no recommendations were produced" % (user, ))
+    # the emails go out from the mailer threads, and each user is marked done only once their send returned
+    mailer = Mailer(make_transport(), concurrency=args.concurrency, rate=args.rate, retries=args.retries)
+    subject = tnow_str + " Arxiv Sanity Lite recommendations"
+    counts = {'sent': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def on_sent(user, future):
+        if future.exception() is not None:
+            print("sending email to %s failed: %s" % (user, future.exception()))
+            status = 'failed'
+        else:
+            status = 'sent'
+            if checkpoint is not None:
+                checkpoint.mark(user, status)
+        with counts_lock:
+            counts[status] += 1
+
+    for user, html in results:
+        if html is None:
+            if checkpoint is not None:
+                checkpoint.mark(user, 'skipped')
             continue
 
-        # render the html
-        print("rendering top %d recommendations into a report for %s..." % (args.num_recommendations, user))
-        html = render_recommendations(user, tags, pids, scores)
         # temporarily for debugging write recommendations to disk for manual inspection
         if os.path.isdir('recco'):
             with open('recco/%s.html' % (user, ), 'w') as f:
                 f.write(html)
 
         # actually send the email
-        print("sending email...")
-        send_email(email, html)
-        num_sent += 1
+        print("sending email to %s..." % (user, ))
+        future = mailer.submit(emails[user], subject, html)
+        future.add_done_callback(functools.partial(on_sent, user))
 
-        # zzz?
-        # time.sleep(1 + random.uniform(0, 2))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    mailer.close() # waits for the sends in flight
+    if checkpoint is not None:
+        checkpoint.close()
 
     print("done.")
-    print("sent %d emails" % (num_sent, ))
-
+    print("sent %d emails" % (counts['sent'], ))
+    if counts['failed']:
+        print("%d emails failed, run again with the same run id to retry them" % (counts['failed'], ))
@@ -10,7 +10,8 @@ ideas:
 import os
 import re
 import time
-from random import shuffle
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from sklearn import svm
@@ -21,8 +22,13 @@ from flask import g # global session-level object
 from flask import session
 from flask import jsonify
 
-from aslite.db import get_papers_db, get_metas_db, get_tags_db, get_last_active_db, get_email_db
-from aslite.db import load_features
+from aslite.db import get_papers_db, get_metas_db, get_tags_db, get_email_db
+from aslite.db import LastActiveBuffer
+from aslite.db import get_cards_db, fetch_cards
+from aslite.db import get_search_index
+from aslite.db import current_time_index, TimeIndex
+from aslite.db import current_features
+from aslite.db import get_recommendations_db, tags_fingerprint, REC_TIME_DELTA
 
 from ai_things.text_to_speech import generate_tts
 from ai_things.llm import summarize_paper
@@ -31,6 +37,7 @@ from ai_things.llm import summarize_paper
 # inits and globals
 
 RET_NUM = 25 # number of papers to return per page
+RANK_CACHE_BYTES = 256 * 1024 * 1024 # memory budget of the svm ranking cache, per process
 
 app = Flask(__name__)
 
@@ -44,6 +51,9 @@ else:
     sk = 'devkey'
 app.secret_key = sk
 
+# buffers the last active time of users in memory and writes them out in batches
+last_active = LastActiveBuffer()
+
 # -----------------------------------------------------------------------------
 # globals that manage the (lazy) loading of various state for a request
 
@@ -51,124 +61,237 @@ def get_tags():
     if g.user is None:
         return {}
     if not hasattr(g, '_tags'):
-        with get_tags_db() as tags_db:
+        with get_tags_db(flag='r') as tags_db:
             tags_dict = tags_db[g.user] if g.user in tags_db else {}
         g._tags = tags_dict
     return g._tags
 
+def get_pid_tags():
+    # reverse of get_tags(): pid -> list of the user's tags that contain it, built once per request
+    if not hasattr(g, '_pid_tags'):
+        pid_tags = {}
+        for tag, pids in get_tags().items():
+            for pid in pids:
+                pid_tags.setdefault(pid, []).append(tag)
+        g._pid_tags = pid_tags
+    return g._pid_tags
+
 def get_papers():
     if not hasattr(g, '_pdb'):
-        g._pdb = get_papers_db()
+        g._pdb = get_papers_db(flag='r')
     return g._pdb
 
+def get_cards():
+    if not hasattr(g, '_cdb'):
+        g._cdb = get_cards_db(flag='r')
+    return g._cdb
+
 def get_metas():
     if not hasattr(g, '_mdb'):
-        g._mdb = get_metas_db()
+        g._mdb = get_metas_db(flag='r')
     return g._mdb
 
+def get_time_index():
+    if not hasattr(g, '_tidx'):
+        tidx = current_time_index()
+        if tidx is None:
+            # arxiv_daemon.py has not written the index yet, build it from metas for this request
+            tidx = TimeIndex.from_metas(get_metas().items())
+        g._tidx = tidx
+    return g._tidx
+
+def get_search():
+    if not hasattr(g, '_sidx'):
+        g._sidx = get_search_index()
+    return g._sidx
+
+def get_features():
+    # the features stay resident in the process across requests, but we pin
+    # a single snapshot per request so a concurrent reload can't mix versions
+    if not hasattr(g, '_features'):
+        g._features = current_features()
+    return g._features
+
 @app.before_request
 def before_request():
     g.user = session.get('user', None)
     # record activity on this user so we can reserve periodic
     # recommendations heavy compute only for active users
     if g.user:
-        with get_last_active_db(flag='c') as last_active_db:
-            last_active_db[g.user] = int(time.time())
+        last_active.touch(g.user)
 
 @app.teardown_request
 def close_connection(error=None):
-    # close any opened database connections
-    if hasattr(g, '_pdb'):
-        g._pdb.close()
-    if hasattr(g, '_mdb'):
-        g._mdb.close()
+    # the sqlite dict handles are pooled per process and stay open,
+    # only the search index connection is opened per request
+    if getattr(g, '_sidx', None) is not None:
+        g._sidx.close()
+
+# -----------------------------------------------------------------------------
+# cache of svm ranking results, so that paginating or revisiting a ranking doesn't retrain
+
+class RankCache:
+    """
+    an LRU cache of svm (scores, words) results, bounded by the total bytes of the
+    score arrays it holds. every entry also stores a fingerprint of the positive set
+    it was trained on, so an entry made stale by a tag edit in another worker process
+    is never served, while edits in this process invalidate the entries right away.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict() # key -> (fingerprint, scores, words)
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions, self.invalidations = 0, 0, 0, 0
+
+    def get(self, key, fingerprint):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != fingerprint:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def _drop(self, key):
+        fingerprint, scores, words = self.entries.pop(key)
+        self.nbytes -= scores.nbytes
+
+    def put(self, key, fingerprint, scores, words):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (fingerprint, scores, words)
+            self.nbytes += scores.nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, user, tag):
+        # drop the user's tag rankings that involve this tag, including the special 'all'
+        with self.lock:
+            stale = [k for k in self.entries if k[0] == 'tags' and k[1] == user and (k[2] == 'all' or tag in k[2])]
+            for k in stale:
+                self._drop(k)
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self.lock:
+            return dict(entries=len(self.entries), nbytes=self.nbytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, invalidations=self.invalidations)
+
+rank_cache = RankCache(RANK_CACHE_BYTES)
 
 # -----------------------------------------------------------------------------
 # ranking utilities for completing the search/rank/filter requests
 
+def render_pids(pids):
+    # render a page of papers with just the information we need for the UI. all of
+    # the cards are fetched together in one query, the full records are not needed
+    cards = fetch_cards(get_cards(), pids, pdb=get_papers())
+    pid_tags = get_pid_tags()
+    papers = []
+    for pid in pids:
+        c = cards[pid]
+        thumb_path = 'static/thumb/' + pid + '.jpg'
+        thumb_url = thumb_path if os.path.isfile(thumb_path) else ''
+        papers.append(dict(
+            weight=0.0,
+            id=c['id'],
+            title=c['title'],
+            time=c['time'],
+            authors=c['authors'],
+            tags=c['tags'],
+            utags=pid_tags.get(pid, []),
+            summary=c['summary'],
+            thumb_url=thumb_url,
+            audio_path=f"static/audio/{pid}.wav",
+            summarized_text='',
+            pid=pid  # add pid to identify the paper in the front-end
+        ))
+    return papers
+
 def render_pid(pid):
     # render a single paper with just the information we need for the UI
-    pdb = get_papers()
-    tags = get_tags()
-    thumb_path = 'static/thumb/' + pid + '.jpg'
-    thumb_url = thumb_path if os.path.isfile(thumb_path) else ''
-    d = pdb[pid]
-    try:
-        summarized_text=d['summarized_text']
-    except:
-        summarized_text=""
-    return dict(
-        weight=0.0,
-        id=d['_id'],
-        title=d['title'],
-        time=d['_time_str'],
-        authors=', '.join(a['name'] for a in d['authors']),
-        tags=', '.join(t['term'] for t in d['tags']),
-        utags=[t for t, pids in tags.items() if pid in pids],
-        summary=d['summary'],
-        thumb_url=thumb_url,
-        audio_path=f"static/audio/{pid}.wav",
-        summarized_text=summarized_text,
-        pid=pid  # add pid to identify the paper in the front-end
-    )
-
-def random_rank():
-    mdb = get_metas()
-    pids = list(mdb.keys())
-    shuffle(pids)
-    scores = [0 for _ in pids]
+    return render_pids([pid])[0]
+
+def random_rank(tmin: float = 0.0):
+    # shuffle only the papers newer than tmin, found by binary search in the time index
+    tidx = get_time_index()
+    pids = tidx.pids[tidx.since(tmin):].copy()
+    np.random.shuffle(pids)
+    scores = np.zeros(len(pids))
     return pids, scores
 
-def time_rank():
-    mdb = get_metas()
-    ms = sorted(mdb.items(), key=lambda kv: kv[1]['_time'], reverse=True)
-    tnow = time.time()
-    pids = [k for k, v in ms]
-    scores = [(tnow - v['_time'])/60/60/24 for k, v in ms] # time delta in days
+def time_rank(tmin: float = 0.0):
+    # the time index is sorted oldest first, so this is a reversed view of its tail
+    tidx = get_time_index()
+    lo = tidx.since(tmin)
+    pids = tidx.pids[lo:][::-1]
+    scores = (time.time() - tidx.times[lo:][::-1])/60/60/24 # time delta in days
     return pids, scores
 
-def svm_rank(tags: str = '', pid: str = '', C: float = 0.01):
+def svm_rank(tags: str = '', pid: str = '', C: float = 0.01, feats: str = 'tfidf'):
 
     # tag can be one tag or a few comma-separated tags or 'all' for all tags we have in db
     # pid can be a specific paper id to set as positive for a kind of nearest neighbor search
+    # feats is the feature set to train on: the sparse tfidf, or its dense low-rank lsa projection
     if not (tags or pid):
         return [], [], []
 
-    # load all of the features
-    features = load_features()
-    x, pids = features['x'], features['pids']
+    # fetch the features, these are already resident in the process
+    features = get_features()
+    if features.lsa is None:
+        feats = 'tfidf' # compute.py wasn't asked for the lsa projection
+    x = features.lsa if feats == 'lsa' else features.x
+    itop, ptoi = features.pids, features.ptoi
     n, d = x.shape
-    ptoi, itop = {}, {}
-    for i, p in enumerate(pids):
-        ptoi[p] = i
-        itop[i] = p
+
+    # the cache key. rankings by pid don't depend on the user so they are shared
+    if pid:
+        key = ('pid', pid, C, feats, features.version)
+    else:
+        tags_key = 'all' if tags == 'all' else frozenset(tags.split(','))
+        key = ('tags', g.user, tags_key, C, feats, features.version)
 
     # construct the positive set
     y = np.zeros(n, dtype=np.float32)
+    # (papers that compute.py hasn't seen yet have no feature row, and can't be positives)
     if pid:
-        y[ptoi[pid]] = 1.0
+        if pid in ptoi:
+            y[ptoi[pid]] = 1.0
     elif tags:
         tags_db = get_tags()
         tags_filter_to = tags_db.keys() if tags == 'all' else set(tags.split(','))
         for tag, pids in tags_db.items():
             if tag in tags_filter_to:
                 for pid in pids:
-                    y[ptoi[pid]] = 1.0
+                    if pid in ptoi:
+                        y[ptoi[pid]] = 1.0
 
     if y.sum() == 0:
         return [], [], [] # there are no positives?
 
+    # serve from the cache if we trained on exactly these positives before
+    fingerprint = hash(np.flatnonzero(y).tobytes())
+    cached = rank_cache.get(key, fingerprint)
+    if cached is not None:
+        scores, words = cached
+        return itop, scores, words
+
     # classify
     clf = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=C)
     clf.fit(x, y)
-    s = clf.decision_function(x)
-    sortix = np.argsort(-s)
-    pids = [itop[ix] for ix in sortix]
-    scores = [100*float(s[ix]) for ix in sortix]
+    scores = 100 * clf.decision_function(x).astype(np.float32) # unsorted, aligned with the feature rows in itop
 
     # get the words that score most positively and most negatively for the svm
-    ivocab = {v:k for k,v in features['vocab'].items()} # index to word mapping
+    ivocab = features.ivocab # index to word mapping
     weights = clf.coef_[0] # (n_features,) weights of the trained svm
+    if feats == 'lsa':
+        weights = weights @ features.lsa_components # map the weights back to the words
     sortix = np.argsort(-weights)
     words = []
     for ix in list(sortix[:40]) + list(sortix[-20:]):
@@ -177,11 +300,46 @@ def svm_rank(tags: str = '', pid: str = '', C: float = 0.01):
             'weight': weights[ix],
         })
 
-    return pids, scores, words
+    rank_cache.put(key, fingerprint, scores, words)
+    return itop, scores, words
+
+def recommended_rank():
+    # the recommendations recommend.py precomputed for this user, or None if there are none, and
+    # whether they are still fresh, i.e. neither the features nor the user's tags changed since
+    if g.user is None:
+        return None, False
+    with get_recommendations_db(flag='r') as rdb:
+        rec = rdb.get(g.user)
+    if rec is None:
+        return None, False
+    fresh = rec['features_version'] == get_features().store_version and rec['tags'] == tags_fingerprint(get_tags())
+    return rec, fresh
+
+def knn_rank(pid: str = ''):
+    # look up the precomputed nearest neighbors of pid, or return None if compute.py didn't build them
+    features = get_features()
+    if features.knn_ix is None or pid not in features.ptoi:
+        return None
+    i = features.ptoi[pid]
+    itop = features.pids
+    # the paper itself always comes first, just as it would with the svm
+    pids = [pid] + [itop[j] for j in features.knn_ix[i]]
+    scores = 100 * np.concatenate([[1.0], features.knn_sim[i]])
+    return pids, scores
 
 def search_rank(q: str = ''):
     if not q:
         return [], [] # no query? no results
+
+    # answer from the inverted index, only touching the postings of the query terms. note that
+    # the index matches whole tokens, so unlike the substring counting of the fallback below
+    # a query for "net" no longer matches "network"
+    sidx = get_search()
+    if sidx is not None:
+        scores = sidx.score(q)
+        return list(scores.keys()), np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+
+    # the index is built by compute.py, so until then fall back to a brute force scan
     qs = q.lower().strip().split() # split query by spaces and lowercase
 
     pdb = get_papers()
@@ -201,6 +359,27 @@ def search_rank(q: str = ''):
     scores = [p[0] for p in pairs]
     return pids, scores
 
+def pid_mask(pids, subset, ptoi=None):
+    # boolean mask over pids of the entries that are in subset, via the pid -> index map if we have one
+    if ptoi is None:
+        return np.isin(pids, list(subset))
+    keep = np.zeros(len(pids), dtype=bool)
+    keep[[ptoi[pid] for pid in subset if pid in ptoi]] = True
+    return keep
+
+def select_page(scores, keep, start, end, ordered=False):
+    """
+    returns the indices of the results on the page [start, end) among the entries
+    where keep is True. unless the entries are already ordered for display, they
+    are ranked by descending score, but only the top `end` of them ever get sorted
+    """
+    ix = np.flatnonzero(keep)
+    if not ordered:
+        if end < len(ix):
+            ix = ix[np.argpartition(-scores[ix], end - 1)[:end]]
+        ix = ix[np.argsort(-scores[ix], kind='stable')]
+    return ix[start:end]
+
 # -----------------------------------------------------------------------------
 # primary application endpoints
 
@@ -220,13 +399,15 @@ def main():
     default_skip_have = 'no'
 
     # override variables with any provided options via the interface
-    opt_rank = request.args.get('rank', default_rank) # rank type. search|tags|pid|time|random
+    opt_rank = request.args.get('rank', default_rank) # rank type. search|tags|pid|recommended|time|random
     opt_q = request.args.get('q', '') # search request in the text box
     opt_tags = request.args.get('tags', default_tags)  # tags to rank by if opt_rank == 'tag'
     opt_pid = request.args.get('pid', '')  # pid to find nearest neighbors to
     opt_time_filter = request.args.get('time_filter', default_time_filter) # number of days to filter by
     opt_skip_have = request.args.get('skip_have', default_skip_have) # hide papers we already have?
     opt_svm_c = request.args.get('svm_c', '') # svm C parameter
+    opt_pid_rank = request.args.get('pid_rank', 'knn') # how to rank by pid: knn|svm
+    opt_svm_features = request.args.get('svm_features', 'tfidf') # features the svm trains on: tfidf|lsa
     opt_page_number = request.args.get('page_number', '1') # page number for pagination
 
     # if a query is given, override rank to be of type "search"
@@ -240,36 +421,77 @@ def main():
     except ValueError:
         C = 0.01 # sensible default, i think
 
-    # rank papers: by tags, by time, by random
+    # the oldest paper time that passes the time filter, if any
+    tmin = time.time() - float(opt_time_filter)*60*60*24 if opt_time_filter else 0.0
+
+    # rank papers: by tags, by time, by random. each ranker returns its candidate pids and a numpy
+    # array of their scores. time and random come back already in display order, everything else
+    # is ranked by descending score further below, but only as far as the requested page
     words = [] # only populated in the case of svm rank
+    rec_info = '' # freshness of the recommendations, for rank=recommended
+    ordered = False
+    aligned = False # are the scores aligned with the feature rows?
+    rec_days = 0 # if set, keep only the papers of the last this many days that we don't have, like recommend.py
     if opt_rank == 'search':
         pids, scores = search_rank(q=opt_q)
     elif opt_rank == 'tags':
-        pids, scores, words = svm_rank(tags=opt_tags, C=C)
+        pids, scores, words = svm_rank(tags=opt_tags, C=C, feats=opt_svm_features)
+        aligned = len(pids) > 0
     elif opt_rank == 'pid':
-        pids, scores, words = svm_rank(pid=opt_pid, C=C)
+        # the precomputed neighbors are a constant time lookup, the svm is an opt-in
+        ranked = knn_rank(pid=opt_pid) if opt_pid_rank == 'knn' else None
+        if ranked is not None:
+            pids, scores = ranked
+        else:
+            pids, scores, words = svm_rank(pid=opt_pid, C=C, feats=opt_svm_features)
+            aligned = len(pids) > 0
+    elif opt_rank == 'recommended':
+        # the precomputed ranking is instant, if it is missing or stale we rank all tags on demand
+        rec, fresh = recommended_rank()
+        if fresh:
+            pids, scores = rec['pids'], rec['scores']
+            rec_info = 'precomputed %.1f hours ago' % ((time.time() - rec['time'])/60/60, )
+        else:
+            # same as recommend.py: one svm per tag merged with a MAX, over the recent papers we don't have,
+            # from as many days back as the last precomputed ones
+            pids, scores = [], None
+            for tag, tpids in get_tags().items():
+                if tpids:
+                    pids, tscores, _ = svm_rank(tags=tag, C=C, feats=opt_svm_features)
+                    scores = tscores if scores is None else np.maximum(scores, tscores)
+            scores = [] if scores is None else scores
+            aligned = len(pids) > 0
+            rec_days = rec.get('time_delta', REC_TIME_DELTA) if rec is not None else REC_TIME_DELTA
+            rec_info = 'computed just now, the precomputed ones were missing or out of date'
     elif opt_rank == 'time':
-        pids, scores = time_rank()
+        pids, scores = time_rank(tmin) # already time filtered
+        ordered = True
     elif opt_rank == 'random':
-        pids, scores = random_rank()
+        pids, scores = random_rank(tmin) # already time filtered
+        ordered = True
     else:
         raise ValueError("opt_rank %s is not a thing" % (opt_rank, ))
-
-    # filter by time
-    if opt_time_filter:
-        mdb = get_metas()
-        kv = {k:v for k,v in mdb.items()} # read all of metas to memory at once, for efficiency
-        tnow = time.time()
-        deltat = int(opt_time_filter)*60*60*24 # allowed time delta in seconds
-        keep = [i for i,pid in enumerate(pids) if (tnow - kv[pid]['_time']) < deltat]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
+    scores = np.asarray(scores, dtype=np.float64)
+    keep = np.ones(len(scores), dtype=bool)
+    # svm scores are aligned with the feature rows, so we can mask with the pid -> row map
+    ptoi = get_features().ptoi if aligned else None
+
+    # filter by time, the recent papers are just the tail of the time index
+    if opt_time_filter and not ordered:
+        tidx = get_time_index()
+        keep &= pid_mask(pids, tidx.pids[tidx.since(tmin):], ptoi)
+
+    # the recommendations computed on demand only cover what recommend.py would have recommended
+    if rec_days:
+        tidx = get_time_index()
+        keep &= pid_mask(pids, tidx.pids[tidx.since(time.time() - rec_days*60*60*24):], ptoi)
+        keep &= ~pid_mask(pids, set().union(*get_tags().values()), ptoi)
 
     # optionally hide papers we already have
     if opt_skip_have == 'yes':
         tags = get_tags()
         have = set().union(*tags.values())
-        keep = [i for i,pid in enumerate(pids) if pid not in have]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
+        keep &= ~pid_mask(pids, have, ptoi)
 
     # crop the number of results to RET_NUM, and paginate
     try:
@@ -277,12 +499,13 @@ def main():
     except ValueError:
         page_number = 1
     start_index = (page_number - 1) * RET_NUM # desired starting index
-    end_index = min(start_index + RET_NUM, len(pids)) # desired ending index
-    pids = pids[start_index:end_index]
-    scores = scores[start_index:end_index]
+    end_index = start_index + RET_NUM # desired ending index
+    ix = select_page(scores, keep, start_index, end_index, ordered=ordered)
+    pids = [str(pids[i]) for i in ix]
+    scores = scores[ix]
 
     # render all papers to just the information we need for the UI
-    papers = [render_pid(pid) for pid in pids]
+    papers = render_pids(pids)
     for i, p in enumerate(papers):
         p['weight'] = float(scores[i])
 
@@ -306,6 +529,9 @@ def main():
     context['gvars']['skip_have'] = opt_skip_have
     context['gvars']['search_query'] = opt_q
     context['gvars']['svm_c'] = str(C)
+    context['gvars']['pid_rank'] = opt_pid_rank
+    context['gvars']['svm_features'] = opt_svm_features
+    context['gvars']['rec_info'] = rec_info
     context['gvars']['page_number'] = str(page_number)
     return render_template('index.html', **context)
 
@@ -318,18 +544,17 @@ def inspect():
     if pid not in pdb:
         return "error, malformed pid" # todo: better error handling
 
-    # load the tfidf vectors, the vocab, and the idf table
-    features = load_features()
-    x = features['x']
-    idf = features['idf']
-    ivocab = {v:k for k,v in features['vocab'].items()}
-    pix = features['pids'].index(pid)
-    wixs = np.flatnonzero(np.asarray(x[pix].todense()))
+    # fetch the tfidf vectors, the vocab, and the idf table
+    features = get_features()
+    if pid not in features.ptoi:
+        return "error, features for this pid are not computed yet"
+    idf, ivocab = features.idf, features.ivocab
+    row = features.x[features.ptoi[pid]] # (1, d) sparse row of this paper
     words = []
-    for ix in wixs:
+    for ix, weight in zip(row.indices, row.data):
         words.append({
             'word': ivocab[ix],
-            'weight': float(x[pix, ix]),
+            'weight': float(weight),
             'idf': float(idf[ix]),
         })
     words.sort(key=lambda w: w['weight'], reverse=True)
@@ -345,7 +570,7 @@ def inspect():
 @app.route('/profile')
 def profile():
     context = default_context()
-    with get_email_db() as edb:
+    with get_email_db(flag='r') as edb:
         email = edb.get(g.user, '')
         context['email'] = email
     return render_template('profile.html', **context)
@@ -353,15 +578,13 @@ def profile():
 @app.route('/stats')
 def stats():
     context = default_context()
-    mdb = get_metas()
-    kv = {k:v for k,v in mdb.items()} # read all of metas to memory at once, for efficiency
-    times = [v['_time'] for v in kv.values()]
+    tidx = get_time_index()
     tstr = lambda t: time.strftime('%b %d %Y', time.localtime(t))
 
-    context['num_papers'] = len(kv)
-    if len(kv) > 0:
-        context['earliest_paper'] = tstr(min(times))
-        context['latest_paper'] = tstr(max(times))
+    context['num_papers'] = len(tidx)
+    if len(tidx) > 0:
+        context['earliest_paper'] = tstr(tidx.times[0])
+        context['latest_paper'] = tstr(tidx.times[-1])
     else:
         context['earliest_paper'] = 'N/A'
         context['latest_paper'] = 'N/A'
@@ -369,10 +592,15 @@ def stats():
     # count number of papers from various time deltas to now
     tnow = time.time()
     for thr in [1, 6, 12, 24, 48, 72, 96]:
-        context['thr_%d' % thr] = len([t for t in times if t > tnow - thr*60*60])
+        context['thr_%d' % thr] = len(tidx) - tidx.since(tnow - thr*60*60)
 
     return render_template('stats.html', **context)
 
+@app.route('/stats/cache')
+def cache_stats():
+    # hit/miss counters of this worker's ranking cache, to help size RANK_CACHE_BYTES
+    return jsonify(rank_cache.stats())
+
 @app.route('/about')
 def about():
     context = default_context()
@@ -406,6 +634,7 @@ def add(pid=None, tag=None):
 
         # write back to database
         tags_db[g.user] = d
+    rank_cache.invalidate(g.user, tag)
 
     print("added paper %s to tag %s for user %s" % (pid, tag, g.user))
     return "ok: " + str(d) # return back the user library for debugging atm
@@ -439,6 +668,7 @@ def sub(pid=None, tag=None):
 
                 # write back the resulting dict to database
                 tags_db[g.user] = d
+                rank_cache.invalidate(g.user, tag)
                 return "ok removed pid %s from tag %s" % (pid, tag)
             else:
                 return "user doesn't have paper %s in tag %s" % (pid, tag)
@@ -463,6 +693,7 @@ def delete_tag(tag=None):
 
         # write back to database
         tags_db[g.user] = d
+    rank_cache.invalidate(g.user, tag)
 
     print("deleted tag %s for user %s" % (tag, g.user))
     return "ok: " + str(d) # return back the user library for debugging atm